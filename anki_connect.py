@@ -0,0 +1,167 @@
+import json
+import time
+import profiling
+
+# requests is imported on the first call, so scripts that never reach Anki do not pay for it
+
+# AnkiConnect URL
+ANKI_CONNECT_URL = 'http://localhost:8765'
+
+# Seconds to wait for an answer before a request counts as failed
+REQUEST_TIMEOUT = 30
+
+# Failed requests of idempotent actions are retried, waiting RETRY_BACKOFF seconds and twice as long each time after
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.5
+
+# Actions that leave Anki in the same state when repeated, so a request that timed out can safely be sent again
+IDEMPOTENT_ACTIONS = {
+    'version', 'deckNames', 'getTags', 'findNotes', 'findCards', 'notesInfo', 'cardsInfo', 'notesModTime',
+    'cardsModTime', 'areSuspended', 'addTags', 'removeTags', 'updateNoteTags', 'suspend', 'unsuspend',
+}
+
+# Bulk requests start with INITIAL_CHUNK_SIZE items per request and adapt between the bounds, aiming for
+# requests that answer within TARGET_LATENCY seconds so Anki's window stays responsive
+INITIAL_CHUNK_SIZE = 100
+MIN_CHUNK_SIZE = 5
+MAX_CHUNK_SIZE = 2000
+TARGET_LATENCY = 0.5
+
+# Raised when AnkiConnect cannot be reached, times out, or answers with an error.
+# retryable is True for failures that may pass when the request is sent again.
+class AnkiConnectError(Exception):
+    def __init__(self, message, retryable=False):
+        super().__init__(message)
+        self.retryable = retryable
+
+# Sends one request without retrying
+def _post(action, params, timeout):
+    import requests
+    request_payload = json.dumps({
+        'action': action,
+        'version': 6,
+        'params': params
+    })
+    start = time.perf_counter()
+    failed = True
+    try:
+        try:
+            response = requests.post(ANKI_CONNECT_URL, data=request_payload, timeout=timeout)
+        except requests.exceptions.Timeout:
+            raise AnkiConnectError(f"AnkiConnect did not answer '{action}' within {timeout} seconds", retryable=True)
+        except requests.exceptions.ConnectionError:
+            raise AnkiConnectError("Could not connect to AnkiConnect, make sure Anki is open", retryable=True)
+        if response.status_code != 200:
+            raise AnkiConnectError(f"AnkiConnect API request failed with status code {response.status_code}", retryable=response.status_code >= 500)
+        response_json = response.json()
+        if response_json.get('error'):
+            raise AnkiConnectError(response_json['error'])
+        failed = False
+    finally:
+        profiling.record_request(action, time.perf_counter() - start, failed)
+    return response_json['result']
+
+# Function to call AnkiConnect, idempotent actions are retried with backoff after timeouts and connection errors
+def invoke(action, params=None, timeout=REQUEST_TIMEOUT, retries=None):
+    if retries is None:
+        retries = MAX_RETRIES if action in IDEMPOTENT_ACTIONS else 0
+    attempt = 0
+    while True:
+        try:
+            return _post(action, params or {}, timeout)
+        except AnkiConnectError as e:
+            if not e.retryable or attempt >= retries:
+                raise
+            time.sleep(RETRY_BACKOFF * 2 ** attempt)
+            attempt += 1
+
+# Splits a bulk request into chunks and adapts the chunk size to how quickly Anki answers: it grows while
+# requests are fast, shrinks in proportion when they are slow, and halves after a timeout before retrying
+class AdaptiveBatcher:
+    def __init__(self, action, chunk_size=INITIAL_CHUNK_SIZE):
+        self.action = action
+        self.chunk_size = chunk_size
+        self.requests = 0
+        self.items = 0
+        self.elapsed = 0.0
+
+    # Sends the items chunk by chunk and yields each chunk with its result; params builds a request from a chunk
+    def stream(self, items, params):
+        start = 0
+        failures = 0
+        while start < len(items):
+            chunk = items[start:start + self.chunk_size]
+            request_start = time.perf_counter()
+            try:
+                result = invoke(self.action, params(chunk), retries=0)
+            except AnkiConnectError as e:
+                if not e.retryable or failures >= MAX_RETRIES:
+                    raise
+                self.chunk_size = max(MIN_CHUNK_SIZE, self.chunk_size // 2)
+                time.sleep(RETRY_BACKOFF * 2 ** failures)
+                failures += 1
+                continue
+            latency = time.perf_counter() - request_start
+            failures = 0
+            self.requests += 1
+            self.items += len(chunk)
+            self.elapsed += latency
+            start += len(chunk)
+            self.adapt(latency, len(chunk))
+            yield chunk, result
+
+    # Sends every item and returns the results of all chunks joined into one list
+    def run(self, items, params):
+        results = []
+        for chunk, result in self.stream(items, params):
+            if isinstance(result, list):
+                results.extend(result)
+        return results
+
+    def adapt(self, latency, chunk_length):
+        if latency > TARGET_LATENCY:
+            self.chunk_size = max(MIN_CHUNK_SIZE, int(chunk_length * TARGET_LATENCY / latency))
+        elif latency < TARGET_LATENCY / 2 and chunk_length == self.chunk_size:
+            self.chunk_size = min(MAX_CHUNK_SIZE, self.chunk_size * 2)
+
+    def report(self):
+        if not self.requests:
+            return f"{self.action}: no requests"
+        seconds = max(self.elapsed, 1e-9)
+        return (f"{self.action}: {self.items} items in {self.requests} requests, {self.requests / seconds:.1f} requests/s, "
+                f"{self.items / seconds:.0f} items/s (chunk size {self.chunk_size})")
+
+# Runs one bulk action over all items and prints the throughput it achieved
+def _bulk(action, items, params, quiet=False):
+    batcher = AdaptiveBatcher(action)
+    results = batcher.run(list(items), params)
+    if not quiet and batcher.requests:
+        print(batcher.report())
+    return results
+
+# Information on notes (fields, tags, card IDs), in the order of the note IDs
+def notes_info(note_ids, quiet=False):
+    return _bulk('notesInfo', [int(note_id) for note_id in note_ids], lambda chunk: {'notes': chunk}, quiet)
+
+# Information on cards (queue, note ID), in the order of the card IDs
+def cards_info(card_ids, quiet=False):
+    return _bulk('cardsInfo', [int(card_id) for card_id in card_ids], lambda chunk: {'cards': chunk}, quiet)
+
+# Modification times of notes and cards, as lists of {'noteId' or 'cardId', 'mod'}
+def notes_mod_time(note_ids, quiet=False):
+    return _bulk('notesModTime', [int(note_id) for note_id in note_ids], lambda chunk: {'notes': chunk}, quiet)
+
+def cards_mod_time(card_ids, quiet=False):
+    return _bulk('cardsModTime', [int(card_id) for card_id in card_ids], lambda chunk: {'cards': chunk}, quiet)
+
+def add_tags(note_ids, tags, quiet=False):
+    _bulk('addTags', [int(note_id) for note_id in note_ids], lambda chunk: {'notes': chunk, 'tags': ' '.join(tags)}, quiet)
+
+def remove_tags(note_ids, tags, quiet=False):
+    _bulk('removeTags', [int(note_id) for note_id in note_ids], lambda chunk: {'notes': chunk, 'tags': ' '.join(tags)}, quiet)
+
+def suspend(card_ids, quiet=False):
+    _bulk('suspend', [int(card_id) for card_id in card_ids], lambda chunk: {'cards': chunk}, quiet)
+
+def unsuspend(card_ids, quiet=False):
+    _bulk('unsuspend', [int(card_id) for card_id in card_ids], lambda chunk: {'cards': chunk}, quiet)
@@ -1,33 +1,39 @@
-import requests
 import json
 import re
 import os
 import sys
 import pickle
+import time
+import shutil
+import queue
+import threading
+import argparse
+import profiling
+import anki_connect
+import note_store
+import bm25_index
 from tqdm import tqdm
-from sentence_transformers import SentenceTransformer
-
-# AnkiConnect URL
-ANKI_CONNECT_URL = 'http://localhost:8765'
-
-# Function to call AnkiConnect
-def invoke(action, params={}):
-    request_payload = json.dumps({
-        'action': action,
-        'version': 6,
-        'params': params
-    })
-    response = requests.post(ANKI_CONNECT_URL, data=request_payload)
-    if response.status_code != 200:
-        raise Exception(f"AnkiConnect API request failed with status code {response.status_code}")
-    response_json = response.json()
-    if response_json.get('error'):
-        raise Exception(response_json['error'])
-    return response_json['result']
+import numpy as np
+import embedding_backend
+
+# Number of notes fetched, encoded and written to disk together as one checkpoint shard
+SHARD_SIZE = 1000
+
+# Notes requested by the first notesInfo call of the fetch stage, later calls adapt to how quickly Anki answers
+FETCH_BATCH_SIZE = 100
+
+# Texts handed to the model per encode call, multiplied by the number of workers when a pool is used
+ENCODE_BATCH_SIZE = 256
+
+# Maximum number of batches waiting between two pipeline stages
+QUEUE_DEPTH = 8
+
+# Notes of the deck used as pseudo-queries when comparing a PCA-reduced store with the full embeddings
+PSEUDO_QUERIES = 50
 
 # Function to get all note IDs in a specific deck
 def get_all_notes_in_deck(deck_name):
-    note_ids = invoke('findNotes', {'query': f'deck:"{deck_name}"'})
+    note_ids = anki_connect.invoke('findNotes', {'query': f'deck:"{deck_name}"'})
     print(f"Found {len(note_ids)} notes in deck '{deck_name}'.")
     return note_ids
 
@@ -111,20 +117,17 @@ def clean_text(text):
     
     return text
 
-# Function to get the first part of the text of a note and clean it
-def get_note_text(note_id):
-    note_info = invoke('notesInfo', {'notes': [note_id]})
-    fields = note_info[0]['fields']
-    first_field = next(iter(fields.values()))['value']
-    text = first_field.split('|')[0]
-    text = clean_text(text)
-    return text
+# Function to get the part of a note's first field before '|'
+def get_first_field(note_info):
+    first_field = next(iter(note_info['fields'].values()))['value']
+    return first_field.split('|')[0]
 
-# Function to check if embeddings exist and ask user for update
-def check_for_embeddings(pickle_file):
-    if os.path.exists(pickle_file):
+# Function to check if the deck was already embedded and ask user for update
+def check_for_embeddings(pickle_dir, deck_name):
+    entry = next((entry for entry in note_store.load_catalog(pickle_dir) if entry['deck'] == deck_name), None)
+    if entry:
         while True:
-            choice = input(f"Embeddings file '{pickle_file}' already exists. Do you want to recreate it? (y/n): ").strip().lower()
+            choice = input(f"Deck '{deck_name}' was already embedded on {entry['built']} ({entry['note_count']} notes). Do you want to recreate it? (y/n): ").strip().lower()
             if choice in ['y', 'n']:
                 return choice == 'y'
             print("Invalid input. Please enter 'y' or 'n'.")
@@ -135,24 +138,219 @@ def save_note_tuples(file_path, note_tuples):
     with open(file_path, 'w') as f:
         f.write(str(note_tuples))
 
+# Directory holding the checkpoint shards of an unfinished run for a deck
+def get_checkpoint_dir(pickle_dir, deck_name):
+    return os.path.join(pickle_dir, 'checkpoints', note_store.deck_slug(deck_name))
+
+# Lists the finished shard files of a checkpoint in the order they were written
+def list_shards(checkpoint_dir):
+    if not os.path.isdir(checkpoint_dir):
+        return []
+    return sorted(f for f in os.listdir(checkpoint_dir) if f.startswith('shard_') and f.endswith('.pkl'))
+
+# Loads one shard of note IDs, texts and embeddings
+def load_shard(checkpoint_dir, shard_file):
+    with open(os.path.join(checkpoint_dir, shard_file), 'rb') as f:
+        return pickle.load(f)
+
+# Writes a shard through a temporary file so a crash never leaves a half-written shard behind
+def write_shard(checkpoint_dir, shard_index, note_ids, texts, embeddings):
+    shard_path = os.path.join(checkpoint_dir, f'shard_{shard_index:05d}.pkl')
+    with open(shard_path + '.tmp', 'wb') as f:
+        pickle.dump((note_ids, texts, embeddings), f)
+    os.replace(shard_path + '.tmp', shard_path)
+
+# Asks whether to resume from an earlier checkpoint and returns the IDs of the notes it already holds. Only a run
+# with the same model and backend can be resumed, so one store never mixes embeddings from different backends.
+def prepare_checkpoint(checkpoint_dir, deck_name, resume, backend='torch'):
+    shard_files = list_shards(checkpoint_dir)
+    manifest_path = os.path.join(checkpoint_dir, 'manifest.json')
+    if shard_files and os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get('model') == embedding_backend.MODEL_NAME and manifest.get('backend') != backend:
+            print(f"The unfinished run for '{deck_name}' used the {manifest.get('backend', 'unrecorded')} backend, "
+                  f"starting over with the {backend} backend.")
+        elif manifest.get('model') == embedding_backend.MODEL_NAME:
+            done_ids = set()
+            for shard_file in shard_files:
+                done_ids.update(load_shard(checkpoint_dir, shard_file)[0])
+            if not resume:
+                choice = input(f"An unfinished run for '{deck_name}' has {len(done_ids)} notes embedded. Resume it? (y/n): ").strip().lower()
+                resume = choice == 'y'
+            if resume:
+                print(f"Resuming, {len(done_ids)} notes will be skipped.")
+                return done_ids, len(shard_files)
+
+    # Start a fresh checkpoint
+    shutil.rmtree(checkpoint_dir, ignore_errors=True)
+    os.makedirs(checkpoint_dir)
+    with open(manifest_path, 'w') as f:
+        json.dump({'deck': deck_name, 'model': embedding_backend.MODEL_NAME, 'backend': backend, 'shard_size': SHARD_SIZE}, f)
+    return set(), 0
+
+# Joins the shards into single lists and one embedding array, keeping only notes still in the deck
+def consolidate_shards(checkpoint_dir, note_ids_in_deck):
+    wanted = set(note_ids_in_deck)
+    shard_files = list_shards(checkpoint_dir)
+    note_card_ids = []
+    note_card_texts = []
+    keep_masks = []
+    dimension, dtype = 0, np.float32
+    for shard_file in shard_files:
+        shard_ids, shard_texts, shard_embeddings = load_shard(checkpoint_dir, shard_file)
+        keep = [note_id in wanted for note_id in shard_ids]
+        note_card_ids.extend(note_id for note_id, kept in zip(shard_ids, keep) if kept)
+        note_card_texts.extend(text for text, kept in zip(shard_texts, keep) if kept)
+        keep_masks.append(keep)
+        dimension = shard_embeddings.shape[1]
+        dtype = shard_embeddings.dtype
+
+    # The embeddings are copied shard by shard into one preallocated array
+    embeddings = np.zeros((len(note_card_ids), dimension), dtype=dtype)
+    row = 0
+    for shard_file, keep in zip(shard_files, keep_masks):
+        shard_embeddings = load_shard(checkpoint_dir, shard_file)[2][keep]
+        embeddings[row:row + len(shard_embeddings)] = shard_embeddings
+        row += len(shard_embeddings)
+    return note_card_ids, note_card_texts, embeddings
+
+# Pipeline stage: fetches notes from AnkiConnect in adaptively sized chunks and queues their raw first fields.
+# Notes deleted in Anki during the run come back without fields and are counted in skipped instead.
+def fetch_notes_worker(note_ids, raw_queue, errors, batcher, skipped):
+    try:
+        with profiling.stage('fetch'):
+            for batch_ids, note_infos in batcher.stream(note_ids, lambda chunk: {'notes': chunk}):
+                found = [(note_id, note_info) for note_id, note_info in zip(batch_ids, note_infos) if note_info.get('fields')]
+                skipped.append(len(batch_ids) - len(found))
+                raw_queue.put(([note_id for note_id, note_info in found], [get_first_field(note_info) for note_id, note_info in found]))
+    except Exception as e:
+        errors.append(e)
+    finally:
+        raw_queue.put(None)
+
+# Pipeline stage: cleans the raw fields and queues the texts for encoding
+def clean_notes_worker(raw_queue, clean_queue, errors):
+    try:
+        while True:
+            item = raw_queue.get()
+            if item is None:
+                break
+            batch_ids, raw_texts = item
+            with profiling.stage('clean'):
+                texts = [clean_text(text) for text in raw_texts]
+            clean_queue.put((batch_ids, texts))
+    except Exception as e:
+        errors.append(e)
+    finally:
+        clean_queue.put(None)
+
+# Fetches and cleans notes in background threads while the model loads and encodes, writing shards as they fill.
+# The bounded queues keep the fetcher from running far ahead of the encoder, so network I/O and inference overlap.
+def embed_notes_pipelined(note_ids, load_model, checkpoint_dir, shard_index, encode_batch_size):
+    raw_queue = queue.Queue(maxsize=QUEUE_DEPTH)
+    clean_queue = queue.Queue(maxsize=QUEUE_DEPTH)
+    errors = []
+    skipped = []
+    batcher = anki_connect.AdaptiveBatcher('notesInfo', FETCH_BATCH_SIZE)
+    threading.Thread(target=fetch_notes_worker, args=(note_ids, raw_queue, errors, batcher, skipped), daemon=True).start()
+    threading.Thread(target=clean_notes_worker, args=(raw_queue, clean_queue, errors), daemon=True).start()
+
+    # The model loads while the first notes are being fetched
+    with profiling.stage('model_load'):
+        model = load_model()
+
+    pending_ids, pending_texts = [], []
+    shard_ids, shard_texts, shard_embeddings = [], [], []
+    finished = False
+    with tqdm(total=len(note_ids), desc="Processing notes", unit="note") as progress:
+        while not finished:
+            item = clean_queue.get()
+            if item is None:
+                finished = True
+            else:
+                pending_ids.extend(item[0])
+                pending_texts.extend(item[1])
+
+            # Encode as soon as a full batch is waiting, and whatever is left once the fetcher is done
+            while len(pending_texts) >= encode_batch_size or (finished and pending_texts):
+                batch_ids, batch_texts = pending_ids[:encode_batch_size], pending_texts[:encode_batch_size]
+                del pending_ids[:encode_batch_size], pending_texts[:encode_batch_size]
+                with profiling.stage('encode'):
+                    shard_embeddings.append(model.encode(batch_texts, batch_size=32, show_progress_bar=False))
+                shard_ids.extend(batch_ids)
+                shard_texts.extend(batch_texts)
+                progress.update(len(batch_ids))
+
+                # Finished shards go to disk and are released from memory
+                if len(shard_ids) >= SHARD_SIZE or (finished and not pending_texts):
+                    write_shard(checkpoint_dir, shard_index, shard_ids, shard_texts, np.vstack(shard_embeddings))
+                    shard_index += 1
+                    shard_ids, shard_texts, shard_embeddings = [], [], []
+
+    print(batcher.report())
+    if sum(skipped):
+        print(f"{sum(skipped)} notes were deleted in Anki during the run and skipped")
+
+    # Notes encoded before a fetch error are already in the checkpoint, so the run can be resumed
+    if errors:
+        raise errors[0]
+    return model
+
+# Ranks the deck against pseudo-queries with the full and the reduced embeddings and reports how much the
+# top 250 lists agree, along with the memory and scoring time saved
+def report_projection(normalized, reduced, projection, explained, top_k=250):
+    import similarity
+    rng = np.random.default_rng(0)
+    queries = normalized[rng.choice(len(normalized), min(PSEUDO_QUERIES, len(normalized)), replace=False)]
+    k = min(top_k, len(normalized))
+    overlaps = []
+    full_time = reduced_time = 0.0
+    for query in queries:
+        start = time.perf_counter()
+        full_scores = similarity.scan_scores(query, normalized)
+        full_time += time.perf_counter() - start
+        start = time.perf_counter()
+        reduced_scores = similarity.scan_scores(note_store.project_rows(query, projection), reduced)
+        reduced_time += time.perf_counter() - start
+        full_top = np.argpartition(-full_scores, k - 1)[:k]
+        reduced_top = np.argpartition(-reduced_scores, k - 1)[:k]
+        overlaps.append(len(np.intersect1d(full_top, reduced_top)) / k)
+    print('*' * 40)
+    print(f"PCA projection: {normalized.shape[1]} -> {reduced.shape[1]} dimensions, {explained:.1%} of the variance kept")
+    print(f"Top-{k} agreement with the full embeddings over {len(queries)} pseudo-queries: "
+          f"mean {np.mean(overlaps):.1%}, lowest {np.min(overlaps):.1%}")
+    print(f"Note store: {reduced.nbytes / 1e6:.1f} MB instead of {normalized.nbytes / 1e6:.1f} MB")
+    print(f"Scoring time: {reduced_time / len(queries) * 1000:.2f} ms instead of {full_time / len(queries) * 1000:.2f} ms per query")
+    print('*' * 40)
+
 if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser(description="Embed the notes of an Anki deck for use by doc_comparison.py.")
+    parser.add_argument('--profile', action='store_true', help="record per-stage timing, AnkiConnect round trips and peak memory, saved to 'debugging/'")
+    parser.add_argument('--int8', action='store_true', help="also save an int8-quantized copy of the embeddings for 'doc_comparison.py --int8'")
+    parser.add_argument('--backend', choices=embedding_backend.BACKENDS, default='torch', help="inference backend for the embedding model (default: torch)")
+    parser.add_argument('--threads', type=int, default=None, help="number of CPU threads used by the embedding model")
+    parser.add_argument('--workers', type=int, default=1, help="encode with this many worker processes (each uses --threads threads, default 1)")
+    parser.add_argument('--token-budget', type=int, default=embedding_backend.TOKEN_BUDGET, help=f"padded tokens per length-bucketed encoding batch, 0 for fixed batches of 32 (default: {embedding_backend.TOKEN_BUDGET})")
+    parser.add_argument('--memory-limit', type=int, default=embedding_backend.MEMORY_LIMIT_MB, help=f"estimated activation memory per encoding batch in MB (default: {embedding_backend.MEMORY_LIMIT_MB})")
+    parser.add_argument('--pca', type=int, default=None, help="reduce the saved embeddings to this many dimensions (e.g. 128 or 256) with a PCA projection fitted on the deck")
+    parser.add_argument('--resume', action='store_true', help="resume an unfinished run for the selected deck without asking")
+    args = parser.parse_args()
+    if args.profile:
+        profiling.enable_profiling('anki_deck_embedding', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'debugging'))
+
     # Create directories if they do not exist
     os.makedirs(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pickle'), exist_ok=True)
     os.makedirs(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'debugging'), exist_ok=True)
     os.makedirs(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'input'), exist_ok=True)
     os.makedirs(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'output'), exist_ok=True)
 
-    # Embedding file path
-    pickle_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pickle', 'note_card_embeddings.pkl')
-
-    # Check if embeddings already exist and ask user for update
-    if not check_for_embeddings(pickle_file):
-        print(f"Using existing embeddings from {pickle_file}")
-        sys.exit(1)
+    # Each deck is embedded into its own shard folder and listed in the catalog
+    pickle_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pickle')
 
     # Get the list of decks
-    decks = invoke('deckNames')
+    decks = anki_connect.invoke('deckNames')
     if not decks:
         print("No decks found in Anki.")
         sys.exit(1)
@@ -174,36 +372,70 @@ if __name__ == '__main__':
 
     selected_deck = decks[deck_choice]
     print(f"Selected deck: {selected_deck}")
+    store_dir = note_store.deck_store_dir(pickle_dir, selected_deck)
+
+    # Check if embeddings already exist and ask user for update
+    if not check_for_embeddings(pickle_dir, selected_deck):
+        print(f"Using existing embeddings from {store_dir}")
+        sys.exit(1)
 
     # Get all notes in the selected deck
     note_ids_in_deck = get_all_notes_in_deck(selected_deck)
     print(f"Total number of notes in deck '{selected_deck}': {len(note_ids_in_deck)}")
 
-    # Lists to hold the tuples of noteID and text, noteID, and texts
-    note_tuples = []
-    note_card_ids = []
-    note_card_texts = []
+    # Earlier unfinished runs for this deck can be resumed from their checkpoint shards
+    checkpoint_dir = get_checkpoint_dir(pickle_dir, selected_deck)
+    done_ids, shard_index = prepare_checkpoint(checkpoint_dir, selected_deck, args.resume, args.backend)
+    remaining_note_ids = [note_id for note_id in note_ids_in_deck if note_id not in done_ids]
 
-    # Process each note in the selected deck
-    for note_id in tqdm(note_ids_in_deck, desc="Processing notes", unit="note"):
-        text = get_note_text(note_id)
-        note_tuples.append((note_id, text))
-        note_card_ids.append(note_id)
-        note_card_texts.append(text)
+    # Fetch, clean and encode the remaining notes as one pipeline, each shard is written to disk as soon as it is encoded
+    model = embed_notes_pipelined(
+        remaining_note_ids,
+        lambda: embedding_backend.load_encoder(args.backend, args.threads, args.workers, args.token_budget, args.memory_limit),
+        checkpoint_dir,
+        shard_index,
+        ENCODE_BATCH_SIZE * max(1, args.workers),
+    )
+    if args.workers > 1:
+        model.close()
+
+    # Join the shards into the final store
+    with profiling.stage('consolidate'):
+        note_card_ids, note_card_texts, embeddings = consolidate_shards(checkpoint_dir, note_ids_in_deck)
 
     # Save original note tuples to a file
     original_file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'debugging', f'note_id_text.txt')
-    save_note_tuples(original_file_path, note_tuples)
+    save_note_tuples(original_file_path, list(zip(note_card_ids, note_card_texts)))
     print(f"Original note tuples saved to {original_file_path}")
 
-    # Load the model
-    model = SentenceTransformer('sentence-transformers/all-mpnet-base-v2')
+    # Optionally fit a PCA projection on the deck and keep only the reduced embeddings
+    projection = None
+    if args.pca and args.pca >= embeddings.shape[1]:
+        print(f"--pca must be below the model's {embeddings.shape[1]} dimensions, saving the full embeddings.")
+    elif args.pca:
+        with profiling.stage('pca'):
+            full_normalized = note_store.normalize_rows(embeddings)
+            projection, explained = note_store.fit_projection(full_normalized, args.pca)
+            embeddings = note_store.project_rows(full_normalized, projection)
+
+    # Save IDs, texts and memory-mappable embeddings to the deck's shard
+    with profiling.stage('save'):
+        normalized = note_store.save_note_store(store_dir, note_card_ids, note_card_texts, embeddings, projection=projection)
 
-    # Generate embeddings for the note cards
-    embeddings = model.encode(note_card_texts, batch_size=32, show_progress_bar=True)
+        # The keyword index for hybrid ranking is small and quick to build, so it is always saved
+        bm25_index.BM25Index.build(note_card_texts).save(store_dir)
 
-    # Save embeddings and IDs to a pickle file
-    with open(pickle_file, 'wb') as f:
-        pickle.dump((note_card_ids, note_card_texts, embeddings), f)
+        # The int8 codes are held in memory at query time, the float32 copy is only read for re-ranking
+        if args.int8:
+            quantized_bytes, float_bytes = note_store.save_quantized_codes(store_dir, normalized)
+            print(f"Int8 note store saved ({quantized_bytes / 1e6:.1f} MB in memory vs {float_bytes / 1e6:.1f} MB for float32)")
+        if projection is not None:
+            note_store.update_catalog(pickle_dir, selected_deck, len(note_card_ids), embedding_backend.MODEL_NAME, int(normalized.shape[1]), projected_from=int(projection.shape[1]))
+        else:
+            note_store.update_catalog(pickle_dir, selected_deck, len(note_card_ids), embedding_backend.MODEL_NAME, int(normalized.shape[1]))
+    if projection is not None:
+        report_projection(full_normalized, normalized, projection, explained)
 
-    print(f"Embeddings saved to {pickle_file}")
\ No newline at end of file
+    # The shards are no longer needed once the final store is written
+    shutil.rmtree(checkpoint_dir, ignore_errors=True)
+    print(f"Embeddings saved to {store_dir}")
@@ -0,0 +1,195 @@
+import os
+import json
+import time
+import sqlite3
+import argparse
+import profiling
+import anki_connect
+
+# Local SQLite copy of the tags of notes and the queue of their cards, kept in 'cache/'. Reads are served from
+# it after an incremental sync that only refetches notes and cards whose modification time changed in Anki.
+MIRROR_NAME = 'anki_mirror.sqlite'
+
+# SQLite limits the number of values in one query
+QUERY_CHUNK_SIZE = 900
+
+# Queue of suspended cards
+SUSPENDED_QUEUE = -1
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS notes (
+    note_id INTEGER PRIMARY KEY,
+    mod INTEGER,
+    tags TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS cards (
+    card_id INTEGER PRIMARY KEY,
+    note_id INTEGER NOT NULL,
+    mod INTEGER,
+    queue INTEGER,
+    type INTEGER
+);
+CREATE INDEX IF NOT EXISTS cards_by_note ON cards (note_id);
+'''
+
+_mirror = None
+
+# The mirror shared by everything in this process
+def open_mirror():
+    global _mirror
+    if _mirror is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+        os.makedirs(cache_dir, exist_ok=True)
+        _mirror = AnkiMirror(os.path.join(cache_dir, MIRROR_NAME))
+    return _mirror
+
+# Splits a list of IDs for queries with an IN clause
+def _chunks(ids):
+    ids = list(ids)
+    for start in range(0, len(ids), QUERY_CHUNK_SIZE):
+        yield ids[start:start + QUERY_CHUNK_SIZE]
+
+class AnkiMirror:
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+
+    def _select(self, query, ids):
+        rows = []
+        for chunk in _chunks(ids):
+            rows.extend(self.connection.execute(query.format(','.join('?' * len(chunk))), chunk).fetchall())
+        return rows
+
+    # Modification times stored for notes or cards, by ID
+    def _stored_mod_times(self, table, id_column, ids):
+        return dict(self._select(f'SELECT {id_column}, mod FROM {table} WHERE {id_column} IN ({{}})', ids))
+
+    # IDs whose modification time in Anki differs from the mirror, and the current modification times. Anki
+    # rejects the whole request when one of the IDs no longer exists; the IDs deleted in Anki are then looked up,
+    # dropped from the mirror and left out, so the following syncs stay incremental.
+    def _changed(self, table, id_column, ids, fetch_mod_times, mod_key):
+        try:
+            current = {entry[mod_key]: entry['mod'] for entry in fetch_mod_times(ids, quiet=True)}
+        except anki_connect.AnkiConnectError as e:
+            if e.retryable:
+                raise
+            ids = self._drop_deleted(table, ids)
+            current = {entry[mod_key]: entry['mod'] for entry in fetch_mod_times(ids, quiet=True)} if ids else {}
+        stored = self._stored_mod_times(table, id_column, ids)
+        return [item_id for item_id in ids if item_id not in stored or stored[item_id] != current.get(item_id)], current
+
+    # Keeps the IDs that still exist in Anki and removes the others from the mirror
+    def _drop_deleted(self, table, ids):
+        if table == 'notes':
+            action, search = 'findNotes', 'nid'
+        else:
+            action, search = 'findCards', 'cid'
+        existing = set()
+        for chunk in _chunks(ids):
+            existing.update(anki_connect.invoke(action, {'query': f'{search}:{",".join(str(item_id) for item_id in chunk)}'}))
+        deleted = [item_id for item_id in ids if item_id not in existing]
+        with self.connection:
+            for chunk in _chunks(deleted):
+                placeholders = ','.join('?' * len(chunk))
+                if table == 'notes':
+                    self.connection.execute(f'DELETE FROM notes WHERE note_id IN ({placeholders})', chunk)
+                    self.connection.execute(f'DELETE FROM cards WHERE note_id IN ({placeholders})', chunk)
+                else:
+                    self.connection.execute(f'DELETE FROM cards WHERE card_id IN ({placeholders})', chunk)
+        if deleted:
+            print(f"Anki mirror: {len(deleted)} {table} no longer in Anki, skipped")
+        return [item_id for item_id in ids if item_id in existing]
+
+    # Brings the mirror up to date for the given notes and their cards, returns the number of notes and cards refetched
+    @profiling.timed('mirror_sync')
+    def sync_notes(self, note_ids):
+        start_time = time.perf_counter()
+        note_ids = sorted(set(int(note_id) for note_id in note_ids))
+        changed_notes, note_mod_times = self._changed('notes', 'note_id', note_ids, anki_connect.notes_mod_time, 'noteId')
+        if changed_notes:
+            note_infos = anki_connect.notes_info(changed_notes, quiet=True)
+            with self.connection:
+                for note_id, note_info in zip(changed_notes, note_infos):
+                    if not note_info:
+                        self.connection.execute('DELETE FROM notes WHERE note_id = ?', (note_id,))
+                        self.connection.execute('DELETE FROM cards WHERE note_id = ?', (note_id,))
+                        continue
+                    self.connection.execute('INSERT OR REPLACE INTO notes (note_id, mod, tags) VALUES (?, ?, ?)',
+                                            (note_id, note_mod_times.get(note_id, note_info.get('mod')), json.dumps(note_info['tags'])))
+                    # Cards deleted from the note are dropped, new ones are added and fetched below
+                    cards = note_info['cards']
+                    self.connection.execute(f'DELETE FROM cards WHERE note_id = ? AND card_id NOT IN ({",".join("?" * len(cards))})', [note_id] + cards)
+                    self.connection.executemany('INSERT OR IGNORE INTO cards (card_id, note_id) VALUES (?, ?)', [(card_id, note_id) for card_id in cards])
+
+        card_ids = [card_id for card_ids in self.note_cards(note_ids).values() for card_id in card_ids]
+        changed_cards, card_mod_times = self._changed('cards', 'card_id', card_ids, anki_connect.cards_mod_time, 'cardId')
+        if changed_cards:
+            card_infos = anki_connect.cards_info(changed_cards, quiet=True)
+            with self.connection:
+                for card_id, card_info in zip(changed_cards, card_infos):
+                    if not card_info:
+                        self.connection.execute('DELETE FROM cards WHERE card_id = ?', (card_id,))
+                        continue
+                    self.connection.execute('UPDATE cards SET mod = ?, queue = ?, type = ? WHERE card_id = ?',
+                                            (card_mod_times.get(card_id, card_info.get('mod')), card_info['queue'], card_info.get('type'), card_id))
+        print(f"Anki mirror: {len(note_ids)} notes and {len(card_ids)} cards checked, {len(changed_notes)} notes and "
+              f"{len(changed_cards)} cards refreshed in {time.perf_counter() - start_time:.2f} s")
+        return len(changed_notes), len(changed_cards)
+
+    # Syncs every note of the given decks
+    def sync_decks(self, deck_names):
+        note_ids = []
+        for deck_name in deck_names:
+            note_ids.extend(anki_connect.invoke('findNotes', {'query': f'deck:"{deck_name}"'}))
+        return self.sync_notes(note_ids)
+
+    # Tags of notes, by note ID
+    def note_tags(self, note_ids):
+        return {note_id: json.loads(tags) for note_id, tags in self._select('SELECT note_id, tags FROM notes WHERE note_id IN ({})', [int(n) for n in note_ids])}
+
+    # Card IDs of notes, by note ID
+    def note_cards(self, note_ids):
+        note_cards = {}
+        for card_id, note_id in self._select('SELECT card_id, note_id FROM cards WHERE note_id IN ({}) ORDER BY card_id', [int(n) for n in note_ids]):
+            note_cards.setdefault(note_id, []).append(card_id)
+        return note_cards
+
+    # Queue of cards, by card ID
+    def card_queues(self, card_ids):
+        return dict(self._select('SELECT card_id, queue FROM cards WHERE card_id IN ({})', [int(c) for c in card_ids]))
+
+    # Write-through after changes made in Anki, so the following reads see them without another sync
+    def record_tags_added(self, note_ids, tags):
+        self._update_tags(note_ids, lambda current: current + [tag for tag in tags if tag not in current])
+
+    def record_tags_removed(self, note_ids, tags):
+        self._update_tags(note_ids, lambda current: [tag for tag in current if tag not in tags])
+
+    def _update_tags(self, note_ids, change):
+        with self.connection:
+            for note_id, tags in self.note_tags(note_ids).items():
+                self.connection.execute('UPDATE notes SET tags = ? WHERE note_id = ?', (json.dumps(change(tags)), note_id))
+
+    # Unsuspended cards go back to the queue of their type (new, learning or review)
+    def record_suspended(self, card_ids, suspend):
+        with self.connection:
+            for chunk in _chunks([int(c) for c in card_ids]):
+                placeholders = ','.join('?' * len(chunk))
+                if suspend:
+                    self.connection.execute(f'UPDATE cards SET queue = {SUSPENDED_QUEUE} WHERE card_id IN ({placeholders})', chunk)
+                else:
+                    self.connection.execute(f'UPDATE cards SET queue = type WHERE card_id IN ({placeholders})', chunk)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sync the local mirror of note tags and card states for the embedded decks.")
+    parser.add_argument('--profile', action='store_true', help="record per-stage timing, AnkiConnect round trips and peak memory, saved to 'debugging/'")
+    args = parser.parse_args()
+    if args.profile:
+        profiling.enable_profiling('anki_mirror', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'debugging'))
+    import note_store
+    decks = [entry['deck'] for entry in note_store.load_catalog(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pickle'))]
+    if not decks:
+        print("No embedded decks found. Run anki_deck_embedding.py first.")
+    else:
+        print(f"Syncing {len(decks)} embedded decks: {', '.join(decks)}")
+        open_mirror().sync_decks(decks)
@@ -0,0 +1,117 @@
+import os
+import re
+import math
+import pickle
+from array import array
+from collections import Counter
+from note_store import NOTES_NAME, is_current
+
+# File name of the index inside a note store directory
+INDEX_NAME = 'note_bm25_index.pkl'
+
+# Standard BM25 term frequency saturation and length normalization
+K1 = 1.2
+B = 0.75
+
+# Distinct document terms, highest tf-idf first, used to query the index
+QUERY_TERMS = 64
+
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+')
+
+# Common words that carry no meaning for matching notes
+STOPWORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'can', 'do', 'does', 'for', 'from', 'has', 'have',
+    'how', 'if', 'in', 'into', 'is', 'it', 'its', 'may', 'most', 'no', 'not', 'of', 'on', 'or', 'such', 'than',
+    'that', 'the', 'their', 'then', 'there', 'these', 'this', 'those', 'to', 'was', 'were', 'what', 'when',
+    'which', 'while', 'who', 'will', 'with', 'would', 'you', 'your', 'also', 'more', 'other', 'some', 'very',
+}
+
+# Splits cleaned (lowercase ASCII) text into index terms
+def tokenize(text):
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if len(token) > 1 and token not in STOPWORDS]
+
+# Inverted index over the cleaned note texts, each posting list holds note positions and term counts
+class BM25Index:
+    def __init__(self, postings, note_lengths):
+        self.postings = postings
+        self.note_lengths = note_lengths
+        self.note_count = len(note_lengths)
+        self.average_length = (sum(note_lengths) / self.note_count) if self.note_count and sum(note_lengths) else 1
+
+    @classmethod
+    def build(cls, texts):
+        postings = {}
+        note_lengths = array('I')
+        for position, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            note_lengths.append(sum(counts.values()))
+            for term, count in counts.items():
+                if term not in postings:
+                    postings[term] = (array('I'), array('I'))
+                postings[term][0].append(position)
+                postings[term][1].append(count)
+        return cls(postings, note_lengths)
+
+    # Inverse document frequency, always positive
+    def idf(self, term):
+        note_frequency = len(self.postings[term][0])
+        return math.log(1 + (self.note_count - note_frequency + 0.5) / (note_frequency + 0.5))
+
+    # Scores only the notes in the posting lists of the query terms and returns the best (positions, scores).
+    # With a corpus the IDF and average length come from all of its decks, so scores compare across them.
+    def search(self, query, k, corpus=None):
+        corpus = corpus or self
+        scores = {}
+        for term, weight in query.items():
+            if term not in self.postings:
+                continue
+            idf = corpus.idf(term)
+            positions, counts = self.postings[term]
+            for position, count in zip(positions, counts):
+                length_norm = K1 * (1 - B + B * self.note_lengths[position] / corpus.average_length)
+                scores[position] = scores.get(position, 0.0) + weight * idf * count * (K1 + 1) / (count + length_norm)
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [position for position, score in best], [score for position, score in best]
+
+    def save(self, store_dir):
+        with open(os.path.join(store_dir, INDEX_NAME), 'wb') as f:
+            pickle.dump((self.postings, self.note_lengths), f)
+
+    @classmethod
+    def load(cls, store_dir):
+        with open(os.path.join(store_dir, INDEX_NAME), 'rb') as f:
+            postings, note_lengths = pickle.load(f)
+        return cls(postings, note_lengths)
+
+# IDF and note length statistics over the indexes of several decks, so one query built from the document
+# scores the notes of every deck on the same scale
+class BM25Corpus:
+    def __init__(self, indexes):
+        self.note_frequencies = Counter()
+        total_length = 0
+        self.note_count = 0
+        for index in indexes:
+            self.note_count += index.note_count
+            total_length += sum(index.note_lengths)
+            for term, (positions, counts) in index.postings.items():
+                self.note_frequencies[term] += len(positions)
+        self.average_length = (total_length / self.note_count) if self.note_count and total_length else 1
+
+    def idf(self, term):
+        note_frequency = self.note_frequencies[term]
+        return math.log(1 + (self.note_count - note_frequency + 0.5) / (note_frequency + 0.5))
+
+    # Picks the document's most distinctive terms as the query, weighted by how often they occur in it
+    def document_query(self, text, max_terms=QUERY_TERMS):
+        counts = Counter(term for term in tokenize(text) if term in self.note_frequencies)
+        ranked = sorted(counts, key=lambda term: (1 + math.log(counts[term])) * self.idf(term), reverse=True)
+        return {term: 1 + math.log(counts[term]) for term in ranked[:max_terms]}
+
+# Loads the index of a note store, building it from the note texts when it is missing or older than the store
+def load_or_build_index(store_dir, note_card_texts):
+    if is_current(store_dir, INDEX_NAME, NOTES_NAME):
+        return BM25Index.load(store_dir)
+    print("Building the BM25 index of the note texts...")
+    index = BM25Index.build(note_card_texts)
+    index.save(store_dir)
+    return index
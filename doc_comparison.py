@@ -1,29 +1,103 @@
 import os
 import re
-import pdfplumber
-import pypandoc
-import docx
-import pickle
 from datetime import datetime
-from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
-import requests
 import json
 import sys
-import numpy as np
 import csv
+import time
+import hashlib
+import argparse
+from collections import Counter, deque
+from itertools import islice
+import profiling
+import embedding_backend
+import anki_connect
+import anki_mirror
 
-ANKI_CONNECT_URL = 'http://localhost:8765'
+# The document extractors, the embedding model, NumPy and requests are imported where they are first used,
+# so the file menu appears without waiting for torch and the other heavy libraries to load
+
+# Defines the size and steps of a shifiting reading frame that is used in embedding
+FRAME_SIZE = 30
+STEP_SIZE = 5
+
+# Number of notes listed for the user to choose a cutoff from
+TOP_NOTES = 250
+
+# Hierarchical mode: words per coarse region, notes kept after the coarse pass, and the share of regions re-encoded as dense frames
+REGION_SIZE = 200
+CANDIDATE_NOTES = 2000
+DENSE_REGION_FRACTION = 0.25
+
+# Streaming mode: reading frames encoded and folded into the document vector at a time
+STREAM_CHUNK_FRAMES = 512
+
+# Hybrid mode: candidates taken from each of the dense and BM25 rankings before they are fused
+HYBRID_CANDIDATES = 500
+
+# Lines whose text, ignoring case, spacing and page numbers, appears on at least this share of a PDF's pages
+# (and on at least BOILERPLATE_MIN_PAGES pages) are running headers and footers and are dropped before framing
+BOILERPLATE_PAGE_FRACTION = 0.5
+BOILERPLATE_MIN_PAGES = 3
+
+# Page numbers such as 'Page 3', 'p. 3', '3 of 20' or '3/20'
+PAGE_NUMBER_PATTERN = re.compile(r'\b(page|pg|p)\.?\s*\d+\b|\b\d+\s*(of|/)\s*\d+\b')
+
+# Document types that can be selected from the 'input' directory
+INPUT_FILE_TYPES = ['.pdf', '.txt', '.rtf', '.docx']
+
+# Watch mode: seconds between scans of 'input/', and the file in 'cache/' remembering the processed documents
+WATCH_INTERVAL = 5
+WATCH_STATE_NAME = 'watch_state.json'
+
+# Preprocessed text is cached in 'cache/extraction', keyed by the file's content hash and this version;
+# bump it whenever an extractor or preprocess_text changes so older cached text is no longer used
+EXTRACTOR_VERSION = 3
+EXTRACTION_CACHE_DIR = os.path.join('cache', 'extraction')
+
+# Compares lines of different pages regardless of case and spacing. Numbers are only ignored in lines with a
+# page number or with more numbers than words, so content lines that differ in their numbers stay distinct.
+def boilerplate_key(line):
+    key = ' '.join(line.lower().split())
+    numbers = re.findall(r'\b\d+\b', key)
+    if PAGE_NUMBER_PATTERN.search(key) or len(numbers) > len(re.findall(r'[a-z]+', key)):
+        key = re.sub(r'\b\d+\b', '#', key)
+    return key
+
+# Drops the lines repeated on most pages, such as running headers, footers and page numbers, and returns the
+# remaining pages with the number of lines and words removed
+def remove_repeated_lines(pages):
+    page_lines = [page.splitlines() for page in pages]
+    threshold = max(BOILERPLATE_MIN_PAGES, BOILERPLATE_PAGE_FRACTION * len(pages))
+    page_counts = Counter(key for lines in page_lines for key in {boilerplate_key(line) for line in lines})
+    repeated = {key for key, count in page_counts.items() if key and count >= threshold}
+    kept_pages = []
+    removed_lines = 0
+    removed_words = 0
+    for lines in page_lines:
+        kept = []
+        for line in lines:
+            if boilerplate_key(line) in repeated:
+                removed_lines += 1
+                removed_words += len(line.split())
+            else:
+                kept.append(line)
+        kept_pages.append('\n'.join(kept))
+    return kept_pages, removed_lines, removed_words
 
 # PDF Extraction
 def extract_text_pdfplumber(pdf_path):
-    text = ""
+    import pdfplumber
+    pages = []
     with pdfplumber.open(pdf_path) as pdf:
         for page in pdf.pages:
             page_text = page.extract_text()
             if page_text:
-                text += page_text
-    return text
+                pages.append(page_text)
+    pages, removed_lines, removed_words = remove_repeated_lines(pages)
+    if removed_lines:
+        print(f"Removed {removed_lines} repeated header and footer lines ({removed_words} words, about {removed_words // STEP_SIZE} frames)")
+    return '\n'.join(pages)
 
 # TXT Extraction
 def extract_text_txt(txt_path):
@@ -31,17 +105,120 @@ def extract_text_txt(txt_path):
         text = file.read()
     return text
 
-# RTF Extraction
+# RTF groups whose content is formatting or metadata rather than document text
+RTF_SKIP_DESTINATIONS = {
+    'aftncn', 'aftnsep', 'aftnsepc', 'annotation', 'atnauthor', 'atndate', 'atnicn', 'atnid', 'atnparent', 'atnref',
+    'atntime', 'atrfend', 'atrfstart', 'author', 'background', 'bkmkend', 'bkmkstart', 'blipuid', 'buptim', 'category',
+    'colorschememapping', 'colortbl', 'comment', 'company', 'creatim', 'datafield', 'datastore', 'defchp', 'defpap',
+    'do', 'doccomm', 'docvar', 'dptxbxtext', 'ebcend', 'ebcstart', 'factoidname', 'falt', 'fchars', 'ffdeftext',
+    'ffentrymcr', 'ffexitmcr', 'ffformat', 'ffhelptext', 'ffl', 'ffname', 'ffstattext', 'file', 'filetbl',
+    'fldinst', 'fldtype', 'fname', 'fontemb', 'fontfile', 'fonttbl', 'footer', 'footerf', 'footerl', 'footerr',
+    'formfield', 'ftncn', 'ftnsep', 'ftnsepc', 'g', 'generator', 'gridtbl', 'header', 'headerf',
+    'headerl', 'headerr', 'hl', 'hlfr', 'hlinkbase', 'hlloc', 'hlsrc', 'hsv', 'htmltag', 'info', 'keycode',
+    'keywords', 'latentstyles', 'lchars', 'levelnumbers', 'leveltext', 'lfolevel', 'linkval', 'list', 'listlevel',
+    'listname', 'listoverride', 'listoverridetable', 'listpicture', 'liststylename', 'listtable', 'listtext',
+    'lsdlockedexcept', 'macc', 'maccpr', 'mailmerge', 'manager', 'mmconnectstr', 'mmodso', 'mmquery', 'object',
+    'objdata', 'objclass', 'objname', 'operator', 'panose', 'pgdsctbl', 'picprop', 'pict', 'pn', 'pnseclvl',
+    'pntext', 'pntxta', 'pntxtb', 'printim', 'private', 'propname', 'protend', 'protstart', 'protusertbl', 'pxe',
+    'result', 'revtbl', 'revtim', 'rsidtbl', 'rxe', 'shp', 'shpgrp', 'shpinst', 'shppict', 'shprslt', 'shptxt',
+    'sn', 'sp', 'staticval', 'stylesheet', 'subject', 'sv', 'svb', 'tc', 'template', 'themedata', 'title', 'txe',
+    'ud', 'upr', 'userprops', 'wgrffmtfilter', 'windowcaption', 'writereservation', 'writereservhash', 'xe',
+    'xform', 'xmlattrname', 'xmlattrvalue', 'xmlclose', 'xmlname', 'xmlnstbl', 'xmlopen',
+}
+
+# RTF control words that stand for a character
+RTF_SPECIAL_CHARACTERS = {
+    'par': '\n', 'line': '\n', 'sect': '\n', 'page': '\n', 'row': '\n', 'tab': '\t', 'cell': ' ',
+    'emdash': '\u2014', 'endash': '\u2013', 'emspace': ' ', 'enspace': ' ', 'qmspace': ' ', 'bullet': '\u2022',
+    'lquote': '\u2018', 'rquote': '\u2019', 'ldblquote': '\u201c', 'rdblquote': '\u201d',
+}
+
+# Control words, hex escapes, control symbols, braces, source line breaks and plain characters
+RTF_TOKEN_PATTERN = re.compile(r"\\([a-z]{1,32})(-?\d{1,10})?[ ]?|\\'([0-9a-f]{2})|\\([^a-z])|([{}])|[\r\n]+|(.)", re.I | re.S)
+
+# Reads the text of an RTF document in process, skipping formatting groups and decoding escapes
+def rtf_to_text(rtf):
+    group_stack = []
+    ignorable = False
+    unicode_skip = 1
+    skip = 0
+    codepage = 'cp1252'
+    out = []
+    for match in RTF_TOKEN_PATTERN.finditer(rtf):
+        word, argument, hex_code, symbol, brace, character = match.groups()
+        if brace:
+            skip = 0
+            if brace == '{':
+                group_stack.append((unicode_skip, ignorable))
+            elif group_stack:
+                unicode_skip, ignorable = group_stack.pop()
+        elif symbol:
+            skip = 0
+            if symbol == '*':
+                ignorable = True
+            elif ignorable:
+                pass
+            elif symbol in '{}\\':
+                out.append(symbol)
+            elif symbol == '~':
+                out.append(' ')
+            elif symbol == '_':
+                out.append('-')
+            elif symbol in '\r\n':
+                out.append('\n')
+        elif word:
+            skip = 0
+            word = word.lower()
+            if word in RTF_SKIP_DESTINATIONS:
+                ignorable = True
+            elif ignorable:
+                pass
+            elif word in RTF_SPECIAL_CHARACTERS:
+                out.append(RTF_SPECIAL_CHARACTERS[word])
+            elif word == 'ansicpg' and argument:
+                codepage = f'cp{argument}'
+            elif word == 'uc' and argument:
+                unicode_skip = int(argument)
+            elif word == 'u' and argument:
+                code = int(argument)
+                out.append(chr(code + 0x10000 if code < 0 else code))
+                skip = unicode_skip
+        elif hex_code:
+            if skip > 0:
+                skip -= 1
+            elif not ignorable:
+                try:
+                    out.append(bytes([int(hex_code, 16)]).decode(codepage, errors='replace'))
+                except LookupError:
+                    out.append(bytes([int(hex_code, 16)]).decode('cp1252', errors='replace'))
+        elif character:
+            if skip > 0:
+                skip -= 1
+            elif not ignorable:
+                out.append(character)
+    return ''.join(out)
+
+# RTF Extraction: parsed in process, with pandoc as the fallback for documents the parser cannot read
 def extract_text_rtf(rtf_path):
+    try:
+        with open(rtf_path, 'r', encoding='latin-1') as file:
+            text = rtf_to_text(file.read())
+        if text.strip():
+            return text
+        print(f"No text found in {rtf_path}, retrying with pypandoc.")
+    except Exception as e:
+        print(f"In-process RTF parsing of {rtf_path} failed ({e}), retrying with pypandoc.")
+    import pypandoc
     try:
         text = pypandoc.convert_file(rtf_path, 'plain')
-    except RuntimeError:
+    except (RuntimeError, OSError):
         print(f"Error processing {rtf_path} with pypandoc.")
         text = ""
     return text
 
 # WORD DOC Extraction
 def extract_text_docx(docx_path):
+    import docx
     doc = docx.Document(docx_path)
     text = "\n".join([para.text for para in doc.paragraphs])
     return text
@@ -97,8 +274,7 @@ def save_text_to_file(directory, filename, text):
 # Present the user with a list of files
 def list_files(script_dir):
     input_dir = os.path.join(script_dir, 'input')
-    file_types = ['.pdf', '.txt', '.rtf', '.docx']
-    files = [f for f in os.listdir(input_dir) if any(f.endswith(ext) for ext in file_types)]
+    files = [f for f in os.listdir(input_dir) if any(f.endswith(ext) for ext in INPUT_FILE_TYPES)]
     print()
     if not files:
         print("\nNo suitable files found in the 'input' directory.")
@@ -109,7 +285,58 @@ def list_files(script_dir):
         print(f"{idx + 1}. {file}")
     return files, input_dir
 
+# Extracts the raw text of a supported document, None for other file types
+def extract_text(file_path):
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext == '.pdf':
+        print(f"\nProcessing {file_path} with pdfplumber:")
+        return extract_text_pdfplumber(file_path)
+    elif ext == '.txt':
+        print(f"\nProcessing {file_path} as a text file:")
+        return extract_text_txt(file_path)
+    elif ext == '.rtf':
+        print(f"\nProcessing {file_path} as an RTF file:")
+        return extract_text_rtf(file_path)
+    elif ext == '.docx':
+        print(f"\nProcessing {file_path} with python-docx:")
+        return extract_text_docx(file_path)
+    print("Unsupported file type.")
+    return None
+
+# SHA-256 of a file's contents, read in blocks
+def file_content_hash(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Cache file of the preprocessed text of a document, keyed by content, file type and extractor version
+def extraction_cache_path(script_dir, file_path):
+    ext = os.path.splitext(file_path)[1].lower().lstrip('.')
+    return os.path.join(script_dir, EXTRACTION_CACHE_DIR, f'{file_content_hash(file_path)}_{ext}_v{EXTRACTOR_VERSION}.txt')
+
+# Extracts and preprocesses a document, reusing the cached text when the same contents were extracted before
+def load_preprocessed_text(script_dir, file_path):
+    cache_path = extraction_cache_path(script_dir, file_path)
+    if os.path.exists(cache_path):
+        print(f"\nUsing the cached extraction of {file_path}")
+        with open(cache_path, 'r') as file:
+            return file.read()
+    text = extract_text(file_path)
+    if text is None:
+        return None
+    preprocessed_text = preprocess_text(text)
+    # Failed extractions are not cached, so the next run tries again
+    if preprocessed_text:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path + '.tmp', 'w') as file:
+            file.write(preprocessed_text)
+        os.replace(cache_path + '.tmp', cache_path)
+    return preprocessed_text
+
 # Uses the above functions to preprocess a selected text document for embedding
+@profiling.timed('main_preprocessing')
 def main_preprocessing():
     script_dir = os.path.dirname(os.path.abspath(__file__))
     files, input_dir = list_files(script_dir)
@@ -119,25 +346,10 @@ def main_preprocessing():
     choice = input("\nEnter the number of the file you want to process: ")
     try:
         file_path = os.path.join(input_dir, files[int(choice) - 1])
-        ext = os.path.splitext(file_path)[1].lower()
-        
-        if ext == '.pdf':
-            print(f"\nProcessing {file_path} with pdfplumber:")
-            text = extract_text_pdfplumber(file_path)
-        elif ext == '.txt':
-            print(f"\nProcessing {file_path} as a text file:")
-            text = extract_text_txt(file_path)
-        elif ext == '.rtf':
-            print(f"\nProcessing {file_path} with pypandoc:")
-            text = extract_text_rtf(file_path)
-        elif ext == '.docx':
-            print(f"\nProcessing {file_path} with python-docx:")
-            text = extract_text_docx(file_path)
-        else:
-            print("Unsupported file type.")
+        preprocessed_text = load_preprocessed_text(script_dir, file_path)
+        if preprocessed_text is None:
             return None
         
-        preprocessed_text = preprocess_text(text)
         timestamp = datetime.now().strftime('%Y_%b_%d_%H_%M')
         base_filename = os.path.splitext(os.path.basename(file_path))[0]
         output_filename = f'{base_filename}_{timestamp}_output.txt'
@@ -151,51 +363,301 @@ def main_preprocessing():
         print(f"Failed with error: {e}")
     return None
 
-# Embed creation
-def create_embeddings(text):
+# Extracts every document in the 'input' directory into the extraction cache, so later runs skip extraction
+@profiling.timed('extract_all')
+def extract_all_inputs():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    files, input_dir = list_files(script_dir)
+    cached = 0
+    start_time = time.time()
+    for file_name in files:
+        file_path = os.path.join(input_dir, file_name)
+        if os.path.exists(extraction_cache_path(script_dir, file_path)):
+            cached += 1
+            continue
+        try:
+            load_preprocessed_text(script_dir, file_path)
+        except Exception as e:
+            print(f"Failed to extract {file_name}: {e}")
+    print(f"\n{len(files)} documents in the extraction cache ({cached} already cached) in {time.time() - start_time:.2f} seconds")
 
-    # Defines the LLM that is being used
-    model = SentenceTransformer('sentence-transformers/all-mpnet-base-v2')
+# Joins the words of the reading frames that start at the given word positions
+def split_into_frames(words, frame_starts):
+    frames = []
+    for i in frame_starts:
+        frame = ' '.join(words[i:i + FRAME_SIZE])
+        frames.append(frame)
+    return frames
+
+# Identical frames are encoded once; returns the distinct frames in order of first appearance and, as a NumPy
+# array, how often each one occurs, which is the weight it gets in scoring
+def deduplicate_frames(frames):
+    import numpy as np
+    counts = Counter(frames)
+    return list(counts), np.fromiter(counts.values(), dtype=np.int64, count=len(counts))
 
-    # Defines the size and steps of a shifiting reading frame that is used in embedding
-    frame_size = 30
-    step_size = 5
+# Embed creation, returns the embeddings of the distinct frames and their weights
+@profiling.timed('create_embeddings')
+def create_embeddings(text, backend='torch', threads=None):
+
+    # Defines the LLM that is being used
+    model = embedding_backend.load_model(backend, threads)
 
     # Uses the defined reading frame to divide the text
     words = text.split()
-    frames = []
-    for i in range(0, len(words) - frame_size + 1, step_size):
-        frame = ' '.join(words[i:i + frame_size])
-        frames.append(frame)
-    
-    # Each frame is embedded separately
-    embeddings = model.encode(frames, show_progress_bar=True)
-    return embeddings
+    frames = split_into_frames(words, range(0, len(words) - FRAME_SIZE + 1, STEP_SIZE))
+    unique_frames, weights = deduplicate_frames(frames)
+    if len(unique_frames) < len(frames):
+        print(f"{len(unique_frames)} distinct frames of {len(frames)}, {len(frames) - len(unique_frames)} duplicates not encoded")
+
+    # Each distinct frame is embedded separately
+    embeddings = model.encode(unique_frames, show_progress_bar=True)
+    return embeddings, weights
+
+# Yields the reading frames of a text one at a time, without splitting the whole text into a list of words
+def iter_frames(text):
+    window = deque(maxlen=FRAME_SIZE)
+    for position, match in enumerate(re.finditer(r'\S+', text), start=1):
+        window.append(match.group())
+        if position >= FRAME_SIZE and (position - FRAME_SIZE) % STEP_SIZE == 0:
+            yield ' '.join(window)
+
+# Streaming mode: encodes the frames in fixed-size chunks and folds each chunk into the mean frame vector,
+# so memory depends on the chunk size rather than the length of the document
+@profiling.timed('create_embeddings')
+def stream_frame_vector(text, backend='torch', threads=None, chunk_frames=STREAM_CHUNK_FRAMES):
+    return encode_frame_vector(embedding_backend.load_model(backend, threads), text, chunk_frames)
+
+# Encodes the frames of a document chunk by chunk with an already loaded model, yielding the embeddings of each
+# chunk's distinct frames with their weights. Duplicates are only found within a chunk, so memory stays bounded.
+def iter_encoded_chunks(model, text, chunk_frames=STREAM_CHUNK_FRAMES):
+    frames = iter_frames(text)
+    frame_count = 0
+    encoded_count = 0
+    while True:
+        chunk = list(islice(frames, chunk_frames))
+        if not chunk:
+            break
+        unique_frames, weights = deduplicate_frames(chunk)
+        frame_count += len(chunk)
+        encoded_count += len(unique_frames)
+        yield model.encode(unique_frames), weights
+        print(f"\rEmbedded {frame_count} frames", end='', flush=True)
+    print()
+    if encoded_count < frame_count:
+        print(f"{encoded_count} distinct frames of {frame_count}, {frame_count - encoded_count} duplicates not encoded")
+
+# Encodes a document chunk by chunk with an already loaded model and returns its mean frame vector
+def encode_frame_vector(model, text, chunk_frames=STREAM_CHUNK_FRAMES):
+    import similarity
+    accumulator = similarity.FrameAccumulator()
+    for chunk_embeddings, weights in iter_encoded_chunks(model, text, chunk_frames):
+        accumulator.add(chunk_embeddings, weights)
+    if not accumulator.count:
+        print("The document is shorter than one reading frame.")
+        return None
+    return accumulator.mean_vector()
+
+# Scores the notes of every store with the chosen aggregate of their similarities to all frames. The frames
+# arrive in chunks of (embeddings, weights) and are walked against the notes in tiles, so memory does not
+# depend on the document length.
+@profiling.timed('aggregate_scores')
+def aggregate_note_scores(frame_chunks, store_dirs, aggregate, top_k=5, percentile=90):
+    import note_store
+    import similarity
+    aggregators = []
+    for store_dir in store_dirs:
+        note_matrix = resident_store(store_dir, 'float32', lambda: note_store.load_note_store(store_dir))[2]
+        projection = resident_store(store_dir, 'projection', lambda: note_store.load_projection(store_dir))
+        aggregators.append(similarity.make_aggregator(aggregate, note_matrix, top_k, percentile, projection))
+    for chunk_embeddings, weights in frame_chunks:
+        for aggregator in aggregators:
+            aggregator.add(chunk_embeddings, weights)
+    if not aggregators or not aggregators[0].frame_count:
+        print("The document is shorter than one reading frame.")
+        return None
+    return [aggregator.scores() for aggregator in aggregators]
+
+# Streaming mode with an aggregate other than the mean: each encoded chunk is folded into every store's aggregate
+@profiling.timed('create_embeddings')
+def stream_note_scores(text, store_dirs, aggregate, backend='torch', threads=None, top_k=5, percentile=90):
+    model = embedding_backend.load_model(backend, threads)
+    return aggregate_note_scores(iter_encoded_chunks(model, text), store_dirs, aggregate, top_k, percentile)
+
+# Watch mode keeps every note store and index it loads in memory between documents, keyed by folder and kind
+_resident_stores = None
+
+def keep_stores_resident():
+    global _resident_stores
+    _resident_stores = {}
+
+# Returns the copy of a store kept in memory while the store on disk is unchanged, otherwise loads it
+def resident_store(store_dir, kind, load):
+    import note_store
+    if _resident_stores is None:
+        return load()
+    notes_path = os.path.join(store_dir, note_store.NOTES_NAME)
+    version = os.path.getmtime(notes_path) if os.path.exists(notes_path) else None
+    cached = _resident_stores.get((store_dir, kind))
+    if cached is None or cached[0] != version:
+        stored = load()
+        # A store converted from the older pickle only gets its notes file while loading
+        version = os.path.getmtime(notes_path) if os.path.exists(notes_path) else None
+        cached = (version, stored)
+        _resident_stores[(store_dir, kind)] = cached
+    return cached[1]
+
+# Folders of every embedded deck, or of the older single-deck pickle when no deck catalog exists yet
+def all_note_stores(pickle_directory):
+    import note_store
+    catalog = note_store.load_catalog(pickle_directory)
+    if catalog:
+        return [os.path.join(pickle_directory, entry['directory']) for entry in catalog]
+    if os.path.exists(os.path.join(pickle_directory, note_store.PICKLE_NAME)):
+        return [pickle_directory]
+    return []
+
+# Lets the user pick which embedded decks to compare against, from --decks or a menu when there are several
+def choose_note_stores(decks_argument=None):
+    import note_store
+    pickle_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pickle')
+    catalog = note_store.load_catalog(pickle_directory)
+    if not catalog:
+        store_dirs = all_note_stores(pickle_directory)
+        if not store_dirs:
+            print("No embedded decks found. Run anki_deck_embedding.py first.")
+            sys.exit(1)
+        return store_dirs
+
+    if decks_argument and decks_argument.lower() != 'all':
+        wanted = [name.strip() for name in decks_argument.split(',')]
+        chosen = [entry for entry in catalog if entry['deck'] in wanted]
+        missing = set(wanted) - set(entry['deck'] for entry in chosen)
+        if missing:
+            print(f"Deck(s) not embedded: {', '.join(sorted(missing))}")
+            sys.exit(1)
+    elif decks_argument or len(catalog) == 1:
+        chosen = catalog
+    else:
+        print("\nEmbedded decks:\n")
+        for idx, entry in enumerate(catalog):
+            print(f"{idx + 1}. {entry['deck']} - {entry['note_count']} notes, built {entry['built']}")
+        while True:
+            choice = input("\nEnter the numbers of the decks to compare against (comma-separated), or press <return> for all: ").strip()
+            if not choice:
+                chosen = catalog
+                break
+            try:
+                chosen = [catalog[int(part) - 1] for part in choice.split(',')]
+                assert all(int(part) >= 1 for part in choice.split(','))
+                break
+            except (ValueError, IndexError, AssertionError):
+                print("Invalid selection. Please try again.")
+    return [os.path.join(pickle_directory, entry['directory']) for entry in chosen]
+
+# BM25 index of a deck, built from its note texts the first time it is needed
+def load_lexical_index(store_dir):
+    import note_store
+    import bm25_index
+    return resident_store(store_dir, 'bm25', lambda: bm25_index.load_or_build_index(store_dir, note_store.load_note_store(store_dir)[1]))
+
+# Scores every note of the selected decks against the document frames and returns the best TOP_NOTES.
+# Each deck shard is memory-mapped and scored on its own, and the per-shard best notes are merged.
+# With document_text the dense ranking is fused with BM25 candidates from each deck's lexical index.
+def rank_notes(pdf_text_embeddings, quantized=False, rerank=300, document_text=None, store_dirs=None, query=None, shard_scores=None, frame_weights=None):
+    import numpy as np
+    import note_store
+    import similarity
+    pickle_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pickle')
+    store_dirs = store_dirs or all_note_stores(pickle_directory)
+    dense_count = HYBRID_CANDIDATES if document_text else TOP_NOTES
+    if query is None and shard_scores is None:
+        query = similarity.mean_frame_vector(pdf_text_embeddings, frame_weights)
+    if quantized and shard_scores is not None:
+        print("The int8 note store only speeds up the mean aggregate, scoring in full precision.")
+        quantized = False
+
+    # Hybrid mode: one BM25 query with IDF and note lengths taken over all selected decks, so the lexical
+    # scores of different decks can be merged
+    if document_text:
+        import bm25_index
+        with profiling.stage('compare_embeddings.lexical'):
+            indexes = [load_lexical_index(store_dir) for store_dir in store_dirs]
+            corpus = bm25_index.BM25Corpus(indexes)
+            lexical_query = corpus.document_query(document_text)
+
+    # Candidates are keyed by (shard, row), only their IDs, texts and dense scores are kept once a shard is done
+    dense_candidates = []
+    lexical_candidates = []
+    candidate_notes = {}
+    for shard, store_dir in enumerate(store_dirs):
+
+        # A deck embedded with --pca is scored with the document vector reduced by the deck's own projection
+        projection = resident_store(store_dir, 'projection', lambda: note_store.load_projection(store_dir))
+        shard_query = query if projection is None or query is None else note_store.project_rows(query, projection)
+
+        # The int8 store scans quantized codes and re-scores a shortlist exactly, so the float32 matrix stays on disk
+        if quantized:
+            note_card_ids, note_card_text, codes, scales, note_matrix = resident_store(store_dir, 'int8', lambda: note_store.load_quantized_store(store_dir))
+            with profiling.stage('compare_embeddings.scoring'):
+                top_indices, top_scores = similarity.quantized_top_k(shard_query, codes, scales, note_matrix, k=dense_count, rerank=rerank)
+        else:
+            # Access the embedded anki deck
+            note_card_ids, note_card_text, note_matrix = resident_store(store_dir, 'float32', lambda: note_store.load_note_store(store_dir))
+
+            # Scoring is timed on its own since this stage also waits on the cutoff prompt
+            with profiling.stage('compare_embeddings.scoring'):
+
+                # Calculate average cosine similarity over all frames for each note, unless another aggregate was scored
+                if shard_scores is not None:
+                    average_scores = shard_scores[shard]
+                else:
+                    average_scores = similarity.scan_scores(shard_query, note_matrix)
+
+                # Sort the notes in descending score order and take the first ones
+                top_indices = np.argsort(-average_scores, kind='stable')[:dense_count]
+                top_scores = average_scores[top_indices]
+        for row, score in zip(top_indices.tolist(), top_scores.tolist()):
+            dense_candidates.append((score, (shard, row)))
+            candidate_notes[(shard, row)] = (score, note_card_ids[row], note_card_text[row])
+
+        # Hybrid mode: BM25 only walks the posting lists of the document's key terms
+        if document_text:
+            with profiling.stage('compare_embeddings.lexical'):
+                lexical_rows, lexical_scores = indexes[shard].search(lexical_query, HYBRID_CANDIDATES, corpus)
+                new_rows = [row for row in lexical_rows if (shard, row) not in candidate_notes]
+                if new_rows:
+                    if shard_scores is not None:
+                        new_scores = shard_scores[shard][new_rows]
+                    else:
+                        new_scores = np.asarray(note_matrix[new_rows], dtype=np.float32) @ shard_query
+                    for row, score in zip(new_rows, new_scores.tolist()):
+                        candidate_notes[(shard, row)] = (score, note_card_ids[row], note_card_text[row])
+            lexical_candidates.extend((score, (shard, row)) for row, score in zip(lexical_rows, lexical_scores))
+        del note_matrix
+
+    # Merge the per-shard lists by score
+    dense_candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+    top_keys = [key for score, key in dense_candidates[:dense_count]]
+
+    # The dense and BM25 rankings are fused by reciprocal rank and every listed note is shown with its dense score
+    if document_text:
+        lexical_candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+        lexical_keys = [key for score, key in lexical_candidates[:HYBRID_CANDIDATES]]
+        top_keys = similarity.reciprocal_rank_fusion([top_keys, lexical_keys])
+        print(f"Hybrid ranking: {len(lexical_keys)} BM25 candidates fused with {dense_count} dense candidates")
+
+    # Create a tuple list that contains score, note ID and text for the best notes
+    return [candidate_notes[key] for key in top_keys[:TOP_NOTES]]
 
 # Compares the newly embedded document to the previously embedded and serialized anki deck
-def compare_embeddings(pdf_text_embeddings):
-    current_directory = os.path.dirname(os.path.abspath(__file__))
-    
-    # Access the embedded anki deck
-    note_cards_pickle_file = os.path.join(current_directory, 'pickle', 'note_card_embeddings.pkl')
-    with open(note_cards_pickle_file, 'rb') as f:
-        note_card_ids, note_card_text, note_card_embeddings = pickle.load(f)
-    
-    # Create a similarity matrix frames x notes
-    similarity = cosine_similarity(pdf_text_embeddings, note_card_embeddings)
-    
-    # Calculate average similarity score for each note
-    average_scores = np.mean(similarity, axis=0)
-    
-    # Create a tuple list that contains note ID and score for all notes
-    similarities_list = [(average_scores[i], note_card_ids[i], note_card_text[i]) for i in range(average_scores.shape[0])]
-    
-    # Sort the list in descending score order
-    similarities_list.sort(key=lambda x: x[0], reverse=True)
-    
-    # Take the first 250 items of the sorted list
-    top_similarities = similarities_list[:250]
-    
+@profiling.timed('compare_embeddings')
+def compare_embeddings(pdf_text_embeddings, quantized=False, rerank=300, document_text=None, store_dirs=None, query=None, shard_scores=None, frame_weights=None):
+    top_similarities = rank_notes(pdf_text_embeddings, quantized, rerank, document_text, store_dirs, query, shard_scores, frame_weights)
+    return select_top_notes(top_similarities)
+
+# Shows the ranked notes and asks the user for a cutoff, returns the (note ID, text) pairs above it
+def select_top_notes(top_similarities):
     # Print the list in reverse so the highest scored notes are closest to the user input point
     print("~" * 40)
     print(f"{'Index':<6} {'Score':<10} {'Note ID':<15} {'Text'}")
@@ -233,74 +695,161 @@ def compare_embeddings(pdf_text_embeddings):
     
     return [(note_id, note_text) for score, note_id, note_text in above_cutoff]
 
-# Function to call AnkiConnect
-def invoke(action, params={}):
-    request_payload = json.dumps({
-        'action': action,
-        'version': 6,
-        'params': params
-    })
-    response = requests.post(ANKI_CONNECT_URL, data=request_payload)
-    if response.status_code != 200:
-        raise Exception(f"AnkiConnect API request failed with status code {response.status_code}")
-    response_json = response.json()
-    if response_json.get('error'):
-        raise Exception(response_json['error'])
-    return response_json['result']
-
-# Function to update tags of a note
-def update_note_tags(note_id, new_tags):
-    # Access the information for a given note ID
-    note_info = invoke('notesInfo', {'notes': [note_id]})
-
-    # Identify the existing tags on the note
-    current_tags = note_info[0]['tags']
-
-    # Initialize variables for tracking tag changes
-    added_tags_count = 0
+# Two-level scoring: coarse regions pick candidate notes and the regions that matter for them, then only those
+# regions are embedded as dense frames and only the candidate notes are scored
+@profiling.timed('compare_hierarchical')
+def rank_notes_hierarchical(text, backend='torch', threads=None, report=False, store_dirs=None):
+    import numpy as np
+    import note_store
+    import similarity
+    model = embedding_backend.load_model(backend, threads)
+    store_dirs = store_dirs or all_note_stores(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pickle'))
+
+    # The frames are the same as in create_embeddings, each one belongs to the region its first word is in
+    words = text.split()
+    frame_starts = np.arange(0, len(words) - FRAME_SIZE + 1, STEP_SIZE)
+    if frame_starts.size == 0:
+        print("The document is too short to compare.")
+        return []
+    frame_regions = frame_starts // REGION_SIZE
+    region_count = int(frame_regions[-1]) + 1
+    frames_per_region = np.bincount(frame_regions, minlength=region_count)
+    start_time = time.perf_counter()
+
+    # Coarse pass: one embedding per region, weighted by the number of frames it stands in for
+    region_texts = [' '.join(words[r * REGION_SIZE:(r + 1) * REGION_SIZE + FRAME_SIZE - STEP_SIZE]) for r in range(region_count)]
+    region_vectors = note_store.normalize_rows(model.encode(region_texts, show_progress_bar=False))
+    coarse_query = ((region_vectors * frames_per_region[:, None]).sum(axis=0) / frame_starts.size).astype(np.float32)
+
+    # Each deck is memory-mapped and scanned on its own and only its best rows are kept, so no deck is read
+    # into memory whole. Rows of decks embedded with --pca are scored with the projected query, and the few
+    # candidates are mapped back into the model's space, where their dot products with document vectors are
+    # the same as scoring with projected document vectors.
+    coarse_candidates = []
+    note_count = 0
+    for shard, store_dir in enumerate(store_dirs):
+        note_matrix = note_store.load_note_store(store_dir)[2]
+        projection = note_store.load_projection(store_dir)
+        shard_scores = similarity.scan_scores(coarse_query if projection is None else note_store.project_rows(coarse_query, projection), note_matrix)
+        note_count += len(shard_scores)
+        shard_best = np.argsort(-shard_scores, kind='stable')[:CANDIDATE_NOTES]
+        coarse_candidates.extend(zip(shard_scores[shard_best].tolist(), [shard] * len(shard_best), shard_best.tolist()))
+        del note_matrix
+    coarse_candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+    candidate_count = min(CANDIDATE_NOTES, len(coarse_candidates))
+    candidate_keys = [(shard, row) for score, shard, row in coarse_candidates[:candidate_count]]
+    candidate_ids, candidate_texts, candidate_rows, candidate_key_order = [], [], [], []
+    for shard, store_dir in enumerate(store_dirs):
+        rows = sorted(row for key_shard, row in candidate_keys if key_shard == shard)
+        if not rows:
+            continue
+        store_ids, store_texts, note_matrix = note_store.load_note_store(store_dir)
+        projection = note_store.load_projection(store_dir)
+        shard_rows = np.asarray(note_matrix[rows], dtype=np.float32)
+        candidate_rows.append(shard_rows if projection is None else shard_rows @ projection)
+        candidate_ids.extend(store_ids[row] for row in rows)
+        candidate_key_order.extend((shard, row) for row in rows)
+        candidate_texts.extend(store_texts[row] for row in rows)
+        del note_matrix
+    notes = np.vstack(candidate_rows)
+
+    # The regions most similar to any candidate note are the ones re-encoded as dense frames
+    region_relevance = (region_vectors @ notes.T).max(axis=1)
+    dense_region_count = max(1, int(np.ceil(DENSE_REGION_FRACTION * region_count)))
+    is_dense = np.zeros(region_count, dtype=bool)
+    is_dense[np.argsort(-region_relevance)[:dense_region_count]] = True
+    dense_starts = frame_starts[is_dense[frame_regions]]
+    frame_vectors = note_store.normalize_rows(model.encode(split_into_frames(words, dense_starts), show_progress_bar=True))
+
+    # A region embedding is a unit vector while the mean of its frame vectors is shorter, the dense regions
+    # give the scale to put the remaining coarse regions on the same footing as exact frame sums
+    dense_frame_regions = frame_regions[is_dense[frame_regions]]
+    region_frame_sums = np.zeros_like(region_vectors)
+    np.add.at(region_frame_sums, dense_frame_regions, frame_vectors)
+    dense_regions = np.flatnonzero(is_dense)
+    region_frame_means = region_frame_sums[dense_regions] / frames_per_region[dense_regions, None]
+    scale = float(np.mean(np.sum(region_frame_means * region_vectors[dense_regions], axis=1)))
+    coarse_regions = ~is_dense
+    query = (frame_vectors.sum(axis=0) + scale * (region_vectors[coarse_regions] * frames_per_region[coarse_regions, None]).sum(axis=0)) / frame_starts.size
+
+    # Fine pass: only the candidate notes are scored
+    candidate_scores = notes @ query
+    order = np.argsort(-candidate_scores, kind='stable')[:TOP_NOTES]
+    top_similarities = [(candidate_scores[i], candidate_ids[i], candidate_texts[i]) for i in order]
+    elapsed = time.perf_counter() - start_time
+
+    encode_count = region_count + dense_starts.size
+    print('*' * 40)
+    print(f"Hierarchical scoring: {encode_count} encodes ({region_count} regions + {dense_starts.size} frames) "
+          f"instead of {frame_starts.size} frames, {1 - encode_count / frame_starts.size:.0%} fewer, {elapsed:.1f} s")
+    print(f"Scored {candidate_count} candidate notes of {note_count}")
+
+    # Optionally run the full method as well to show the time saved and how much the ranked lists agree
+    if report:
+        start_time = time.perf_counter()
+        full_vectors = model.encode(split_into_frames(words, frame_starts), show_progress_bar=True)
+        full_query = similarity.mean_frame_vector(full_vectors)
+        full_candidates = []
+        for shard, store_dir in enumerate(store_dirs):
+            note_matrix = note_store.load_note_store(store_dir)[2]
+            projection = note_store.load_projection(store_dir)
+            full_scores = similarity.scan_scores(full_query if projection is None else note_store.project_rows(full_query, projection), note_matrix)
+            shard_best = np.argsort(-full_scores, kind='stable')[:TOP_NOTES]
+            full_candidates.extend(zip(full_scores[shard_best].tolist(), [shard] * len(shard_best), shard_best.tolist()))
+            del note_matrix
+        full_candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+        full_top = {(shard, row) for score, shard, row in full_candidates[:TOP_NOTES]}
+        full_elapsed = time.perf_counter() - start_time
+        hierarchical_top = {candidate_key_order[i] for i in order}
+        overlap = len(full_top & hierarchical_top) / len(full_top)
+        print(f"Full method: {frame_starts.size} encodes, {full_elapsed:.1f} s ({full_elapsed / elapsed:.1f}x the hierarchical time)")
+        print(f"Top-{len(full_top)} overlap with the full method: {overlap:.1%}")
+    print('*' * 40)
+    return top_similarities
+
+# Adds tags to notes with bulk AnkiConnect requests, reading the current tags from the local mirror of Anki.
+# Returns the tags that were new on each note, the number of tags that were already present, and the card IDs
+# of each note.
+def update_note_tags(note_ids, new_tags):
+    mirror = anki_mirror.open_mirror()
+    mirror.sync_notes(note_ids)
+    note_tags = mirror.note_tags(note_ids)
+    note_cards = mirror.note_cards(note_ids)
+    added_tags = {}
     already_present_tags_count = 0
-    added_tags = []
-
-    # Iterate through user provided tags and add only new tags to the note
-    for tag in new_tags:
-        if tag not in current_tags:
-            current_tags.append(tag)
-            added_tags_count += 1
-            added_tags.append(tag)
-        else:
-            already_present_tags_count += 1
-    invoke('updateNoteTags', {'note': note_id, 'tags': current_tags})
-
-    return added_tags_count, already_present_tags_count, added_tags
-
-# Function to suspend or unsuspend cards
-def set_card_suspend(note_id_text):
-
-    # Initialize variables for tracking suspension status changes
-    unsuspended_cards = 0
-    already_processed_cards = 0
-    card_status = {}
-
-    # Iterate through the note IDs
-    for note_id, note_text in note_id_text:
-        card_ids = invoke('findCards', {'query': f'nid:{note_id}'})
-
-        # Identify all cards derrived from a given note
-        if card_ids:
-            card_info = invoke('cardsInfo', {'cards': card_ids})
-            for card in card_info:
-                # If a card is suspended, unsuspend it
-                if card['queue'] == -1:
-                    invoke('unsuspend', {'cards': [card['cardId']]})
-                    card_status[card['cardId']] = 'unsuspended'
-                    unsuspended_cards += 1
-                else:
-                    already_processed_cards += 1
-                    card_status[card['cardId']] = 'already processed'
+    for note_id in note_ids:
+        # Notes deleted since the deck was embedded are not in the mirror
+        if note_id not in note_tags:
+            continue
+        added_tags[note_id] = [tag for tag in new_tags if tag not in note_tags[note_id]]
+        already_present_tags_count += len(new_tags) - len(added_tags[note_id])
+    tagged_note_ids = [note_id for note_id, added in added_tags.items() if added]
+    anki_connect.add_tags(tagged_note_ids, new_tags)
+    mirror.record_tags_added(tagged_note_ids, new_tags)
+    return added_tags, already_present_tags_count, note_cards
 
-    return unsuspended_cards, already_processed_cards, card_status
+# Card IDs of each note
+def get_note_cards(note_ids):
+    mirror = anki_mirror.open_mirror()
+    mirror.sync_notes(note_ids)
+    return mirror.note_cards(note_ids)
+
+# Function to unsuspend the suspended cards of notes, given the card IDs of each note
+def set_card_suspend(note_cards):
+    mirror = anki_mirror.open_mirror()
+    card_ids = [card_id for card_ids in note_cards.values() for card_id in card_ids]
+    card_queues = mirror.card_queues(card_ids)
+
+    # Suspended cards are in queue -1, all of them are unsuspended with bulk requests
+    suspended_cards = [card_id for card_id in card_ids if card_queues.get(card_id) == anki_mirror.SUSPENDED_QUEUE]
+    anki_connect.unsuspend(suspended_cards)
+    mirror.record_suspended(suspended_cards, False)
+    card_status = {card_id: 'already processed' for card_id in card_ids if card_id in card_queues}
+    card_status.update((card_id, 'unsuspended') for card_id in suspended_cards)
+    return len(suspended_cards), len(card_status) - len(suspended_cards), card_status
 
 # Main function for interacting with a users anki data
+@profiling.timed('update_anki')
 def update_anki(note_id_text):
 
     # Ask the user to identify how they would like to modify their anki data for the selected notes
@@ -328,6 +877,8 @@ def update_anki(note_id_text):
     already_unsuspended_cards_count = 0
     output_data = []
 
+    note_ids = [note_id for note_id, note_text in note_id_text]
+
     # Workflow for only adding tags
     if action == 1:
 
@@ -340,33 +891,25 @@ def update_anki(note_id_text):
         # Process user input
         new_tags = [tag.strip() for tag in new_tags_input.split(',')]
 
-        # Iterate through all note IDs to add tag(s)
-        for note_id, note_text in note_id_text:
-            added_tags_count, already_tags_count, added_tags = update_note_tags(note_id, new_tags)
-
-            # Update modification scores
-            tagged_notes_count += added_tags_count
-            already_present_tags_count += already_tags_count
+        # Add the tag(s) to all notes at once and update modification scores
+        added_tags, already_present_tags_count, note_cards = update_note_tags(note_ids, new_tags)
+        tagged_notes_count = sum(len(tags) for tags in added_tags.values())
 
-            # Find card IDs to update data modification output
-            card_ids = invoke('findCards', {'query': f'nid:{note_id}'})
-            for card_id in card_ids:
-                output_data.append((note_id, card_id, note_text, added_tags, ''))
+        # Each card of a tagged note gets a row in the data modification output
+        for note_id, note_text in note_id_text:
+            for card_id in note_cards.get(note_id, []):
+                output_data.append((note_id, card_id, note_text, added_tags[note_id], ''))
 
     # Workflow for only unsuspending cards
     elif action == 2:
 
-        # Call function to unsuspend all suspended cards for each note
-        unsuspended_cards, already_processed_cards, card_status = set_card_suspend(note_id_text)
+        # Call function to unsuspend all suspended cards of the notes
+        note_cards = get_note_cards(note_ids)
+        unsuspended_cards_count, already_unsuspended_cards_count, card_status = set_card_suspend(note_cards)
 
-        # Update modification scores
-        unsuspended_cards_count += unsuspended_cards
-        already_unsuspended_cards_count += already_processed_cards
-
-        # Find card IDs to update data modification output
+        # Each card gets a row in the data modification output
         for note_id, note_text in note_id_text:
-            card_ids = invoke('findCards', {'query': f'nid:{note_id}'})
-            for card_id in card_ids:
+            for card_id in note_cards.get(note_id, []):
                 if card_id in card_status:
                     output_data.append((note_id, card_id, note_text, '', card_status[card_id]))
 
@@ -382,36 +925,15 @@ def update_anki(note_id_text):
         # Process user input
         new_tags = [tag.strip() for tag in new_tags_input.split(',')]
 
-         # Iterate through all note IDs to add tag(s)
-        for note_id, note_text in note_id_text:
-            added_tags_count, already_tags_count, added_tags = update_note_tags(note_id, new_tags)
-            
-            # Update modification scores
-            tagged_notes_count += added_tags_count
-            already_present_tags_count += already_tags_count
-
-            # Find card IDs to update data modification output
-            card_ids = invoke('findCards', {'query': f'nid:{note_id}'})
-            for card_id in card_ids:
-                output_data.append((note_id, card_id, note_text, added_tags, ''))
-
-        # Call function to unsuspend all suspended cards for each note
-        unsuspended_cards, already_processed_cards, card_status = set_card_suspend(note_id_text)
-        
-        # Update modification scores
-        unsuspended_cards_count += unsuspended_cards
-        already_unsuspended_cards_count += already_processed_cards
+        # Add the tag(s) to all notes at once, then unsuspend their suspended cards
+        added_tags, already_present_tags_count, note_cards = update_note_tags(note_ids, new_tags)
+        tagged_notes_count = sum(len(tags) for tags in added_tags.values())
+        unsuspended_cards_count, already_unsuspended_cards_count, card_status = set_card_suspend(note_cards)
 
-        # Find card IDs to update data modification output
+        # Each card gets a row with its added tags and card status
         for note_id, note_text in note_id_text:
-            card_ids = invoke('findCards', {'query': f'nid:{note_id}'})
-            for card_id in card_ids:
-                if card_id in card_status:
-
-                    # Update the existing tuple with card status
-                    for i, record in enumerate(output_data):
-                        if record[1] == card_id:
-                            output_data[i] = (record[0], record[1], record[2], record[3], card_status[card_id])
+            for card_id in note_cards.get(note_id, []):
+                output_data.append((note_id, card_id, note_text, added_tags[note_id], card_status.get(card_id, '')))
 
     # Save the output data to a CSV file with a timestamp
     timestamp = datetime.now().strftime('%Y_%b_%d_%H_%M')
@@ -439,9 +961,218 @@ def update_anki(note_id_text):
     print('-' * 40)
     print(f"Output saved to 'output/{output_filename}'")
 
+# Reads which input documents watch mode has already processed, by file name
+def load_watch_state(state_path):
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path) as f:
+        return json.load(f)
+
+def save_watch_state(state_path, state):
+    os.makedirs(os.path.dirname(state_path), exist_ok=True)
+    with open(state_path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(state_path + '.tmp', state_path)
+
+# Input documents that are new or changed since they were processed. A document is only returned once its
+# size and modification time are the same as on the previous scan, so files still being copied are skipped.
+def find_changed_inputs(input_dir, state, last_seen, failed):
+    ready = []
+    for file_name in sorted(os.listdir(input_dir)):
+        if os.path.splitext(file_name)[1].lower() not in INPUT_FILE_TYPES:
+            continue
+        try:
+            stat = os.stat(os.path.join(input_dir, file_name))
+        except FileNotFoundError:
+            continue
+        signature = [stat.st_size, stat.st_mtime]
+        previous = last_seen.get(file_name)
+        last_seen[file_name] = signature
+        if file_name in state and state[file_name]['signature'] == signature:
+            continue
+        if failed.get(file_name) == signature or previous != signature:
+            continue
+        ready.append((file_name, signature))
+    return ready
+
+# Ranks the notes for one watched document and writes them to 'output/'. Returns the file name and, when a tag
+# rule is set, the tag with the notes it applies to; tagging is done afterwards so the ranking is saved even
+# when Anki is closed.
+@profiling.timed('watch_document')
+def process_watched_file(model, script_dir, file_path, args, store_dirs):
+    text = load_preprocessed_text(script_dir, file_path)
+    if not text:
+        raise ValueError("no text could be extracted")
+    if args.aggregate == 'mean':
+        query, shard_scores = encode_frame_vector(model, text), None
+        scored = query is not None
+    else:
+        query = None
+        shard_scores = aggregate_note_scores(iter_encoded_chunks(model, text), store_dirs, args.aggregate, args.top_k_frames, args.percentile)
+        scored = shard_scores is not None
+    if not scored:
+        raise ValueError("the document is shorter than one reading frame")
+    top_similarities = rank_notes(None, quantized=args.int8, rerank=args.rerank, document_text=text if args.hybrid else None, store_dirs=store_dirs, query=query, shard_scores=shard_scores)
+
+    base_filename = os.path.splitext(os.path.basename(file_path))[0]
+    timestamp = datetime.now().strftime('%Y_%b_%d_%H_%M_%S')
+    output_filename = f'candidates_{base_filename}_{timestamp}.csv'
+    write_watch_candidates(os.path.join(script_dir, 'output', output_filename),
+                           [[rank, f'{score:.4f}', note_id, note_text, ''] for rank, (score, note_id, note_text) in enumerate(top_similarities, start=1)])
+
+    # Tag rule: the first --watch-top notes scoring at least --watch-min-score get the tag
+    pending_tag = None
+    if args.watch_tag:
+        tag = args.watch_tag.replace('{document}', re.sub(r'\s+', '_', base_filename))
+        tag_note_ids = [note_id for score, note_id, note_text in top_similarities[:args.watch_top] if score >= args.watch_min_score]
+        pending_tag = {'tag': tag, 'note_ids': tag_note_ids}
+    return output_filename, pending_tag
+
+def write_watch_candidates(csv_path, rows):
+    with open(csv_path, 'w', newline='') as csvfile:
+        csv_writer = csv.writer(csvfile)
+        csv_writer.writerow(['Rank', 'Score', 'Note ID', 'Note Text', 'Added Tags'])
+        csv_writer.writerows(rows)
+
+# Applies a watched document's tag rule and fills the Added Tags column of its candidates file. Raises
+# AnkiConnectError when Anki cannot be reached, so the caller can try again on a later scan.
+def apply_watch_tag(csv_path, pending_tag):
+    tag = pending_tag['tag']
+    with open(csv_path, newline='') as csvfile:
+        rows = list(csv.reader(csvfile))[1:]
+    new_tags = update_note_tags(pending_tag['note_ids'], [tag])[0]
+    added = {str(note_id) for note_id, tags in new_tags.items() if tags}
+    for row in rows:
+        if row[2] in added:
+            row[4] = tag
+    write_watch_candidates(csv_path, rows)
+    print(f"Tagged {len(added)} notes with '{tag}'")
+
+# Tries the tag rules that could not be applied earlier. A rule is kept for the next scan only while Anki is
+# unreachable; it is dropped once applied, when its candidates file is gone, or when Anki rejects it.
+def retry_pending_tags(script_dir, state, state_path):
+    for file_name, entry in state.items():
+        if not entry.get('pending_tag'):
+            continue
+        try:
+            apply_watch_tag(os.path.join(script_dir, 'output', entry['output']), entry['pending_tag'])
+        except anki_connect.AnkiConnectError as e:
+            if e.retryable:
+                continue
+            print(f"Dropping the tag rule of {file_name}, Anki rejected it: {e}")
+        except FileNotFoundError:
+            print(f"Dropping the tag rule of {file_name}, 'output/{entry['output']}' no longer exists")
+        except Exception as e:
+            print(f"Dropping the tag rule of {file_name}: {e}")
+        del entry['pending_tag']
+        save_watch_state(state_path, state)
+
+# Watch mode: polls 'input/' and processes every new or changed document with the model and note stores
+# kept in memory, so each document only costs its encoding and scoring
+def watch_inputs(args):
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    input_dir = os.path.join(script_dir, 'input')
+    state_path = os.path.join(script_dir, 'cache', WATCH_STATE_NAME)
+    for folder in ('pickle', 'debugging', 'input', 'output'):
+        os.makedirs(os.path.join(script_dir, folder), exist_ok=True)
+    keep_stores_resident()
+    store_dirs = choose_note_stores(args.decks or 'all')
+    model = embedding_backend.load_model(args.backend, args.threads)
+    state = load_watch_state(state_path)
+    last_seen = {}
+    failed = {}
+    queue = deque()
+    print(f"\nWatching {input_dir} every {WATCH_INTERVAL} seconds. Press Ctrl+C to stop.")
+    try:
+        while True:
+            retry_pending_tags(script_dir, state, state_path)
+            for file_name, signature in find_changed_inputs(input_dir, state, last_seen, failed):
+                if all(queued != file_name for queued, _ in queue):
+                    queue.append((file_name, signature))
+
+            while queue:
+                file_name, signature = queue.popleft()
+                file_path = os.path.join(input_dir, file_name)
+                start_time = time.time()
+                try:
+                    content_hash = file_content_hash(file_path)
+                    # Saved again without changes, only the modification time moved
+                    if file_name in state and state[file_name]['hash'] == content_hash:
+                        state[file_name]['signature'] = signature
+                        save_watch_state(state_path, state)
+                        continue
+                    print('∆' * 40)
+                    output_filename, pending_tag = process_watched_file(model, script_dir, file_path, args, store_dirs)
+                except Exception as e:
+                    print(f"Failed to process {file_name}: {e}")
+                    failed[file_name] = signature
+                    continue
+                state[file_name] = {
+                    'hash': content_hash,
+                    'signature': signature,
+                    'processed': datetime.now().isoformat(timespec='seconds'),
+                    'output': output_filename,
+                }
+                print(f"{file_name} done in {time.time() - start_time:.2f} seconds, candidates saved to 'output/{output_filename}'")
+
+                # A tag rule that fails because Anki is unavailable is kept and tried again on the following scans
+                if pending_tag:
+                    try:
+                        apply_watch_tag(os.path.join(script_dir, 'output', output_filename), pending_tag)
+                    except anki_connect.AnkiConnectError as e:
+                        if e.retryable:
+                            print(f"Could not tag the notes of {file_name} ({e}), trying again on the next scan")
+                            state[file_name]['pending_tag'] = pending_tag
+                        else:
+                            print(f"Could not tag the notes of {file_name}: {e}")
+                    except Exception as e:
+                        print(f"Could not tag the notes of {file_name}: {e}")
+                save_watch_state(state_path, state)
+            time.sleep(WATCH_INTERVAL)
+    except KeyboardInterrupt:
+        print("\nStopped watching.")
+
 # Main execution flow
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare a document against the embedded Anki deck and tag or unsuspend related notes.")
+    parser.add_argument('--profile', action='store_true', help="record per-stage timing, AnkiConnect round trips and peak memory, saved to 'debugging/'")
+    parser.add_argument('--int8', action='store_true', help="score notes with the int8-quantized note store and re-rank the shortlist in full precision")
+    parser.add_argument('--rerank', type=int, default=300, help="number of int8 candidates re-scored in full precision (default: 300)")
+    parser.add_argument('--backend', choices=embedding_backend.BACKENDS, default='torch', help="inference backend for the embedding model (default: torch)")
+    parser.add_argument('--threads', type=int, default=None, help="number of CPU threads used by the embedding model")
+    parser.add_argument('--hierarchical', action='store_true', help="coarse-to-fine scoring: embed document regions first and dense frames only where candidate notes match")
+    parser.add_argument('--hierarchical-report', action='store_true', help="with --hierarchical, also run the full method and report time saved and top-250 overlap")
+    parser.add_argument('--hybrid', action='store_true', help="fuse the dense ranking with BM25 keyword matches from the note text index")
+    parser.add_argument('--decks', default=None, help="comma-separated deck names to compare against, or 'all' (default: ask when several decks are embedded)")
+    parser.add_argument('--stream', action='store_true', help="encode the document in fixed-size chunks of frames to keep memory flat for very large documents")
+    parser.add_argument('--watch', action='store_true', help="keep running and process every new or changed document in 'input/', writing ranked candidates to 'output/'")
+    parser.add_argument('--watch-tag', default=None, help="with --watch, tag the best notes of each document; '{document}' is replaced by the file name")
+    parser.add_argument('--watch-top', type=int, default=50, help="with --watch-tag, number of best-ranked notes that can be tagged (default: 50)")
+    parser.add_argument('--watch-min-score', type=float, default=0.0, help="with --watch-tag, lowest score a note needs to be tagged (default: 0)")
+    parser.add_argument('--aggregate', choices=['mean', 'max', 'topk', 'percentile'], default='mean', help="how a note's similarities to all frames are combined into its score (default: mean)")
+    parser.add_argument('--top-k-frames', type=int, default=5, help="with --aggregate topk, number of best frames averaged per note (default: 5)")
+    parser.add_argument('--percentile', type=float, default=90, help="with --aggregate percentile, percentile of a note's frame similarities used as its score (default: 90)")
+    parser.add_argument('--extract-all', action='store_true', help="extract every document in 'input/' into the extraction cache and exit")
+    args = parser.parse_args()
+    if args.profile:
+        profiling.enable_profiling('doc_comparison', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'debugging'))
+    if args.extract_all:
+        os.makedirs(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'input'), exist_ok=True)
+        extract_all_inputs()
+        sys.exit(0)
+    if args.watch:
+        if args.hierarchical:
+            print("--watch does not use --hierarchical, it is ignored.")
+        watch_inputs(args)
+        sys.exit(0)
+
+    # Hierarchical scoring has its own encoding and full-precision mean scoring, the other scoring options don't apply
+    if args.hierarchical:
+        ignored = [flag for flag, used in (('--int8', args.int8), ('--hybrid', args.hybrid), ('--stream', args.stream), ('--aggregate', args.aggregate != 'mean')) if used]
+        if ignored:
+            print(f"--hierarchical always scores with the mean in full precision, {', '.join(ignored)} {'is' if len(ignored) == 1 else 'are'} ignored.")
+
     os.makedirs(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pickle'), exist_ok=True)
     os.makedirs(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'debugging'), exist_ok=True)
     os.makedirs(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'input'), exist_ok=True)
@@ -450,6 +1181,25 @@ if __name__ == "__main__":
     input(f'Place the document(s) you would like to process in {os.path.join(os.path.dirname(os.path.abspath(__file__)), "input")}\n\033[92mPress <return> when ready\033[0m')
     raw_text = main_preprocessing()
     if raw_text:
-        embedded_text = create_embeddings(raw_text)
-        note_id_text = compare_embeddings(embedded_text)
+        store_dirs = choose_note_stores(args.decks)
+    if raw_text and args.hierarchical:
+        top_similarities = rank_notes_hierarchical(raw_text, backend=args.backend, threads=args.threads, report=args.hierarchical_report, store_dirs=store_dirs)
+        note_id_text = select_top_notes(top_similarities)
+        update_anki(note_id_text)
+    elif raw_text and args.stream and args.aggregate != 'mean':
+        shard_scores = stream_note_scores(raw_text, store_dirs, args.aggregate, backend=args.backend, threads=args.threads, top_k=args.top_k_frames, percentile=args.percentile)
+        if shard_scores is not None:
+            note_id_text = compare_embeddings(None, quantized=args.int8, rerank=args.rerank, document_text=raw_text if args.hybrid else None, store_dirs=store_dirs, shard_scores=shard_scores)
+            update_anki(note_id_text)
+    elif raw_text and args.stream:
+        query = stream_frame_vector(raw_text, backend=args.backend, threads=args.threads)
+        if query is not None:
+            note_id_text = compare_embeddings(None, quantized=args.int8, rerank=args.rerank, document_text=raw_text if args.hybrid else None, store_dirs=store_dirs, query=query)
+            update_anki(note_id_text)
+    elif raw_text:
+        embedded_text, frame_weights = create_embeddings(raw_text, backend=args.backend, threads=args.threads)
+        shard_scores = None
+        if args.aggregate != 'mean':
+            shard_scores = aggregate_note_scores([(embedded_text, frame_weights)], store_dirs, args.aggregate, args.top_k_frames, args.percentile)
+        note_id_text = compare_embeddings(embedded_text, quantized=args.int8, rerank=args.rerank, document_text=raw_text if args.hybrid else None, store_dirs=store_dirs, shard_scores=shard_scores, frame_weights=frame_weights)
         update_anki(note_id_text)
\ No newline at end of file
@@ -0,0 +1,432 @@
+import os
+import sys
+import ast
+import time
+import argparse
+import multiprocessing
+
+# NumPy and the model libraries are imported inside the functions that use them, so importing this module
+# (for example to read BACKENDS) does not slow down the start of doc_comparison.py
+
+# The sentence similarity model used for both the deck and the documents
+MODEL_NAME = 'sentence-transformers/all-mpnet-base-v2'
+
+# Selectable inference backends, all of them run on the CPU except the stock 'torch' one which uses any available device
+BACKENDS = ['torch', 'int8', 'onnx', 'onnx-int8']
+
+# Exported ONNX graphs are kept next to the script so the export only happens once
+ONNX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models')
+
+# Sentences sent to a pool worker per task, small enough to keep all workers busy until the end
+POOL_CHUNK_SIZE = 256
+
+# Length-bucketed batching: texts are sorted by token count and a batch only takes texts at least BUCKET_RATIO
+# as long as its longest one, up to TOKEN_BUDGET padded tokens, MAX_BATCH_SIZE texts and an estimated
+# MEMORY_LIMIT_MB of activations, so short notes share large batches while long ones are encoded a few at a time
+TOKEN_BUDGET = 8192
+MAX_BATCH_SIZE = 256
+MEMORY_LIMIT_MB = 1024
+BUCKET_RATIO = 0.8
+
+# Activation memory of one padded token through a transformer layer (hidden states, attention projections and
+# the feed-forward layer in float32), plus the attention scores that grow with the sequence length
+ACTIVATION_BYTES_PER_TOKEN = 32 * 1024
+ATTENTION_HEADS = 12
+
+# The batching benchmark draws note lengths in words from a log-normal distribution, a few words for most
+# cloze and basic notes with a long tail of paragraph-sized ones
+BENCHMARK_MEDIAN_WORDS = 20
+BENCHMARK_SPREAD = 1.0
+BENCHMARK_MAX_WORDS = 350
+
+# Sentences used by the backend check when no embedded deck is available
+SAMPLE_SENTENCES = [
+    "beta blockers reduce heart rate and myocardial oxygen demand",
+    "the loop of henle concentrates urine through a countercurrent mechanism",
+    "streptococcus pyogenes causes pharyngitis, impetigo and rheumatic fever",
+    "warfarin inhibits vitamin k dependent clotting factors ii, vii, ix and x",
+    "the brachial plexus is formed by the ventral rami of c5 to t1",
+    "insulin increases glucose uptake in skeletal muscle and adipose tissue via glut4",
+    "kawasaki disease presents with fever, conjunctivitis, rash and coronary artery aneurysms",
+    "the facial nerve exits the skull through the stylomastoid foramen",
+]
+
+# Limits the number of threads torch uses for intra-op parallelism
+def set_torch_threads(threads):
+    import torch
+    if threads:
+        torch.set_num_threads(threads)
+
+# Loads the model with the selected backend, every backend returns an object with an encode() like SentenceTransformer's
+def load_model(backend='torch', threads=None):
+    from sentence_transformers import SentenceTransformer
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend '{backend}', choose one of {', '.join(BACKENDS)}")
+    set_torch_threads(threads)
+
+    if backend == 'torch':
+        return SentenceTransformer(MODEL_NAME)
+
+    model = SentenceTransformer(MODEL_NAME, device='cpu')
+    if backend == 'int8':
+        import torch
+        # Dynamic quantization stores the linear layer weights as int8 and quantizes activations on the fly
+        transformer = model[0]
+        transformer.auto_model = torch.quantization.quantize_dynamic(transformer.auto_model, {torch.nn.Linear}, dtype=torch.qint8)
+        return model
+    return OnnxSentenceEncoder(model, quantize=(backend == 'onnx-int8'), threads=threads)
+
+# Runs the transformer of a SentenceTransformer through ONNX Runtime, pooling and normalizing like the original
+class OnnxSentenceEncoder:
+    def __init__(self, model, quantize=False, threads=None):
+        try:
+            import onnxruntime
+        except ImportError:
+            print("The ONNX backends need onnxruntime, install it with 'pip3 install onnxruntime'.")
+            sys.exit(1)
+        self.tokenizer = model.tokenizer
+        self.max_seq_length = model.max_seq_length
+        self.normalize = any(type(module).__name__ == 'Normalize' for module in model)
+        onnx_path = export_onnx(model, quantize=quantize)
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads or 0
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+
+    # Encodes sentences in length-sorted batches and returns the embeddings in the original order
+    def encode(self, sentences, batch_size=32, show_progress_bar=False, **kwargs):
+        from tqdm import tqdm
+        import numpy as np
+        order = np.argsort([-len(sentence) for sentence in sentences], kind='stable')
+        embeddings = [None] * len(sentences)
+        batches = range(0, len(sentences), batch_size)
+        for start in tqdm(batches, desc="Batches", disable=not show_progress_bar):
+            batch_indices = order[start:start + batch_size]
+            tokens = self.tokenizer([sentences[i] for i in batch_indices], padding=True, truncation=True, max_length=self.max_seq_length, return_tensors='np')
+            feed = {name: tokens[name].astype(np.int64) for name in self.input_names}
+            token_embeddings = self.session.run(None, feed)[0]
+
+            # Mean pooling over the real (non-padding) tokens
+            mask = tokens['attention_mask'][..., None].astype(np.float32)
+            pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            if self.normalize:
+                pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            for i, vector in zip(batch_indices, pooled):
+                embeddings[i] = vector
+        return np.vstack(embeddings).astype(np.float32) if embeddings else np.zeros((0, 768), dtype=np.float32)
+
+# Estimated activation memory in MB of encoding a batch padded to the given sequence length
+def batch_memory_mb(batch_size, sequence_length):
+    per_token = ACTIVATION_BYTES_PER_TOKEN + 2 * 4 * ATTENTION_HEADS * sequence_length
+    return batch_size * sequence_length * per_token / 2 ** 20
+
+# Token count of each text after truncation, or an estimate from the word count when the model has no tokenizer
+def token_lengths(model, texts):
+    tokenizer = getattr(model, 'tokenizer', None)
+    max_length = getattr(model, 'max_seq_length', None) or 512
+    if tokenizer is None:
+        return [min(max_length, int(len(text.split()) * 1.3) + 2) for text in texts]
+    return [len(ids) for ids in tokenizer(list(texts), truncation=True, max_length=max_length)['input_ids']]
+
+# Groups text positions into batches, longest first so the largest batch runs early; each batch is padded to
+# its first (longest) text and grows while the texts stay in its length bucket and the budget, the batch size
+# cap and the memory limit allow
+def plan_batches(lengths, token_budget=TOKEN_BUDGET, memory_limit_mb=MEMORY_LIMIT_MB, max_batch_size=MAX_BATCH_SIZE):
+    order = sorted(range(len(lengths)), key=lambda i: -lengths[i])
+    batches = []
+    batch = []
+    for i in order:
+        if batch:
+            padded_length = lengths[batch[0]]
+            size = len(batch) + 1
+            if (lengths[i] < BUCKET_RATIO * padded_length or size > max_batch_size or size * padded_length > token_budget
+                    or batch_memory_mb(size, padded_length) > memory_limit_mb):
+                batches.append(batch)
+                batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+# Padded tokens processed by batches of the given positions, the work the model actually does
+def padded_tokens(lengths, batches):
+    return sum(len(batch) * max(lengths[i] for i in batch) for batch in batches)
+
+# Wraps a model so every encode call is split into length-bucketed batches, returning the embeddings in the
+# original order; the batch_size argument of encode is ignored
+class BucketedEncoder:
+    def __init__(self, model, token_budget=TOKEN_BUDGET, memory_limit_mb=MEMORY_LIMIT_MB):
+        self.model = model
+        self.token_budget = token_budget
+        self.memory_limit_mb = memory_limit_mb
+        self.tokenizer = getattr(model, 'tokenizer', None)
+        self.max_seq_length = getattr(model, 'max_seq_length', None)
+        self.batches = 0
+        self.peak_memory_mb = 0.0
+
+    def encode(self, sentences, batch_size=32, show_progress_bar=False, **kwargs):
+        from tqdm import tqdm
+        import numpy as np
+        sentences = list(sentences)
+        if not sentences:
+            return np.zeros((0, 768), dtype=np.float32)
+        lengths = token_lengths(self.model, sentences)
+        embeddings = None
+        for batch in tqdm(plan_batches(lengths, self.token_budget, self.memory_limit_mb), desc="Batches", disable=not show_progress_bar):
+            vectors = np.asarray(self.model.encode([sentences[i] for i in batch], batch_size=len(batch), show_progress_bar=False), dtype=np.float32)
+            if embeddings is None:
+                embeddings = np.empty((len(sentences), vectors.shape[1]), dtype=np.float32)
+            embeddings[batch] = vectors
+            self.batches += 1
+            self.peak_memory_mb = max(self.peak_memory_mb, batch_memory_mb(len(batch), lengths[batch[0]]))
+        return embeddings
+
+# Exports the locally cached transformer to ONNX once, optionally with int8 weights
+def export_onnx(model, quantize=False):
+    import torch
+    os.makedirs(ONNX_DIR, exist_ok=True)
+    base_name = MODEL_NAME.split('/')[-1]
+    onnx_path = os.path.join(ONNX_DIR, f'{base_name}.onnx')
+    if not os.path.exists(onnx_path):
+        print(f"Exporting {MODEL_NAME} to {onnx_path}...")
+
+        # Only the token embeddings are exported, pooling is done in NumPy
+        class TokenEmbeddings(torch.nn.Module):
+            def __init__(self, auto_model):
+                super().__init__()
+                self.auto_model = auto_model
+
+            def forward(self, input_ids, attention_mask):
+                return self.auto_model(input_ids=input_ids, attention_mask=attention_mask)[0]
+
+        dummy = model.tokenizer(["an example sentence"], return_tensors='pt')
+        torch.onnx.export(
+            TokenEmbeddings(model[0].auto_model).eval(),
+            (dummy['input_ids'], dummy['attention_mask']),
+            onnx_path,
+            input_names=['input_ids', 'attention_mask'],
+            output_names=['token_embeddings'],
+            dynamic_axes={'input_ids': {0: 'batch', 1: 'sequence'}, 'attention_mask': {0: 'batch', 1: 'sequence'}, 'token_embeddings': {0: 'batch', 1: 'sequence'}},
+            opset_version=14,
+        )
+    if not quantize:
+        return onnx_path
+
+    quantized_path = os.path.join(ONNX_DIR, f'{base_name}-int8.onnx')
+    if not os.path.exists(quantized_path):
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        print(f"Quantizing {onnx_path} to {quantized_path}...")
+        quantize_dynamic(onnx_path, quantized_path, weight_type=QuantType.QInt8)
+    return quantized_path
+
+# Model loaded once in each pool worker process
+_worker_model = None
+
+# Pool initializer, limits the worker's threads before loading its own copy of the model
+def _init_worker(backend, threads, token_budget=None, memory_limit_mb=MEMORY_LIMIT_MB):
+    global _worker_model
+    import torch
+    torch.set_num_interop_threads(1)
+    _worker_model = load_model(backend, threads)
+    if token_budget:
+        _worker_model = BucketedEncoder(_worker_model, token_budget, memory_limit_mb)
+
+# Encodes one shard of sentences inside a pool worker
+def _encode_shard(task):
+    import numpy as np
+    sentences, batch_size = task
+    return np.asarray(_worker_model.encode(sentences, batch_size=batch_size, show_progress_bar=False), dtype=np.float32)
+
+# Shards sentences across worker processes, each with its own model and thread limit, and gathers results in order.
+# With a token budget every worker batches its shard by length.
+class EncodingPool:
+    def __init__(self, backend='torch', workers=None, threads_per_worker=1, token_budget=None, memory_limit_mb=MEMORY_LIMIT_MB):
+        self.workers = workers or os.cpu_count() or 1
+        context = multiprocessing.get_context('spawn')
+        self.pool = context.Pool(self.workers, initializer=_init_worker, initargs=(backend, threads_per_worker, token_budget, memory_limit_mb))
+
+    def encode(self, sentences, batch_size=32, show_progress_bar=False, chunk_size=POOL_CHUNK_SIZE, **kwargs):
+        from tqdm import tqdm
+        import numpy as np
+        tasks = [(sentences[i:i + chunk_size], batch_size) for i in range(0, len(sentences), chunk_size)]
+        shards = []
+        with tqdm(total=len(sentences), desc="Batches", unit="sentence", disable=not show_progress_bar) as progress:
+            # imap returns shards in submission order, so the output lines up with the input sentences
+            for shard in self.pool.imap(_encode_shard, tasks):
+                shards.append(shard)
+                progress.update(len(shard))
+        if not shards:
+            return np.zeros((0, 768), dtype=np.float32)
+        return np.vstack(shards)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# Loads either a single in-process model or a pool of worker processes, batching by length when a token budget is given
+def load_encoder(backend='torch', threads=None, workers=1, token_budget=None, memory_limit_mb=MEMORY_LIMIT_MB):
+    if workers and workers > 1:
+        return EncodingPool(backend, workers, threads or 1, token_budget, memory_limit_mb)
+    model = load_model(backend, threads)
+    if token_budget:
+        return BucketedEncoder(model, token_budget, memory_limit_mb)
+    return model
+
+# Encodes the texts and returns the embeddings with the achieved sentences per second
+def measure_throughput(model, texts, batch_size=32):
+    import numpy as np
+    start = time.perf_counter()
+    embeddings = model.encode(texts, batch_size=batch_size, show_progress_bar=False)
+    elapsed = time.perf_counter() - start
+    return np.asarray(embeddings, dtype=np.float32), len(texts) / elapsed
+
+# Row-wise cosine similarity between the reference and candidate embeddings
+def row_cosine(reference, candidate):
+    import numpy as np
+    reference = reference / np.clip(np.linalg.norm(reference, axis=1, keepdims=True), 1e-12, None)
+    candidate = candidate / np.clip(np.linalg.norm(candidate, axis=1, keepdims=True), 1e-12, None)
+    return np.sum(reference * candidate, axis=1)
+
+# Uses the cleaned note texts saved by anki_deck_embedding.py when they exist
+def load_sample_texts(limit):
+    note_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'debugging', 'note_id_text.txt')
+    if os.path.exists(note_file):
+        with open(note_file) as f:
+            texts = [text for note_id, text in ast.literal_eval(f.read())]
+        if texts:
+            return texts[:limit]
+    return (SAMPLE_SENTENCES * (limit // len(SAMPLE_SENTENCES) + 1))[:limit]
+
+# Note-like texts with a realistic spread of lengths, built from the sample sentences
+def benchmark_texts(count, seed=0):
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    words = ' '.join(SAMPLE_SENTENCES).split()
+    lengths = np.clip(rng.lognormal(np.log(BENCHMARK_MEDIAN_WORDS), BENCHMARK_SPREAD, count), 3, BENCHMARK_MAX_WORDS).astype(int)
+    texts = []
+    for length in lengths:
+        start = int(rng.integers(len(words)))
+        texts.append(' '.join((words[start:] + words * (length // len(words) + 1))[:length]))
+    return texts
+
+# Compares length-bucketed batching with fixed batches of 32 on note texts, handed to the model in chunks of
+# chunk_size like anki_deck_embedding.py does
+def check_batching(backend, threads, sample_size, token_budget, memory_limit_mb, chunk_size=256):
+    import numpy as np
+    note_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'debugging', 'note_id_text.txt')
+    texts = load_sample_texts(sample_size) if os.path.exists(note_file) else benchmark_texts(sample_size)
+    model = load_model(backend, threads)
+    bucketed = BucketedEncoder(model, token_budget, memory_limit_mb)
+    lengths = token_lengths(model, texts)
+    print(f"Encoding {len(texts)} notes ({np.median(lengths):.0f} median and {max(lengths)} longest tokens) with the {backend} backend")
+
+    # Work and peak batch memory of each scheme; SentenceTransformer sorts each encode call by text length
+    # before cutting it into fixed batches
+    fixed_tokens, fixed_memory, bucketed_tokens, bucketed_memory = 0, 0.0, 0, 0.0
+    for start in range(0, len(texts), chunk_size):
+        chunk = list(range(start, min(start + chunk_size, len(texts))))
+        chunk.sort(key=lambda i: -len(texts[i]))
+        fixed_batches = [chunk[i:i + 32] for i in range(0, len(chunk), 32)]
+        fixed_tokens += padded_tokens(lengths, fixed_batches)
+        fixed_memory = max([fixed_memory] + [batch_memory_mb(len(batch), max(lengths[i] for i in batch)) for batch in fixed_batches])
+        chunk_lengths = [lengths[i] for i in chunk]
+        planned = plan_batches(chunk_lengths, token_budget, memory_limit_mb)
+        bucketed_tokens += padded_tokens(chunk_lengths, planned)
+        bucketed_memory = max([bucketed_memory] + [batch_memory_mb(len(batch), chunk_lengths[batch[0]]) for batch in planned])
+
+    # Warm-up so one-time initialization is not counted
+    model.encode(texts[:32], batch_size=32, show_progress_bar=False)
+    start_time = time.perf_counter()
+    fixed = np.vstack([model.encode(texts[i:i + chunk_size], batch_size=32, show_progress_bar=False) for i in range(0, len(texts), chunk_size)])
+    fixed_rate = len(texts) / (time.perf_counter() - start_time)
+    start_time = time.perf_counter()
+    adaptive = np.vstack([bucketed.encode(texts[i:i + chunk_size]) for i in range(0, len(texts), chunk_size)])
+    bucketed_rate = len(texts) / (time.perf_counter() - start_time)
+    cosines = row_cosine(fixed, adaptive)
+
+    real_tokens = sum(lengths)
+    print('-' * 72)
+    print(f"{'Batching':<12} {'Notes/s':>10} {'Speedup':>9} {'Padded tokens':>15} {'Padding':>9} {'Peak MB':>9}")
+    print(f"{'fixed 32':<12} {fixed_rate:>10.1f} {1.0:>8.2f}x {fixed_tokens:>15} {1 - real_tokens / fixed_tokens:>9.0%} {fixed_memory:>9.0f}")
+    print(f"{'bucketed':<12} {bucketed_rate:>10.1f} {bucketed_rate / fixed_rate:>8.2f}x {bucketed_tokens:>15} {1 - real_tokens / bucketed_tokens:>9.0%} {bucketed_memory:>9.0f}")
+    print('-' * 72)
+    print(f"Token budget {token_budget}, memory limit {memory_limit_mb} MB, {bucketed.batches} bucketed batches; "
+          f"embeddings agree to a minimum cosine of {cosines.min():.5f}")
+
+# Compares each backend against stock torch for cosine agreement and sentences per second
+def check_backends(backends, threads, sample_size, tolerance, batch_size=32):
+    texts = load_sample_texts(sample_size)
+    print(f"Checking {', '.join(backends)} on {len(texts)} sentences with {threads or 'default'} threads")
+    reference_model = load_model('torch', threads)
+    reference, reference_rate = measure_throughput(reference_model, texts, batch_size)
+    del reference_model
+
+    all_passed = True
+    print('-' * 72)
+    print(f"{'Backend':<12} {'Sent/s':>10} {'Speedup':>9} {'Min cos':>10} {'Mean cos':>10} {'Result':>8}")
+    print(f"{'torch':<12} {reference_rate:>10.1f} {1.0:>8.2f}x {1.0:>10.4f} {1.0:>10.4f} {'ref':>8}")
+    for backend in backends:
+        if backend == 'torch':
+            continue
+        model = load_model(backend, threads)
+        candidate, rate = measure_throughput(model, texts, batch_size)
+        cosines = row_cosine(reference, candidate)
+        passed = bool(cosines.min() >= tolerance)
+        all_passed = all_passed and passed
+        print(f"{backend:<12} {rate:>10.1f} {rate / reference_rate:>8.2f}x {cosines.min():>10.4f} {cosines.mean():>10.4f} {'pass' if passed else 'FAIL':>8}")
+        del model
+    print('-' * 72)
+    print(f"Cosine tolerance: every embedding must be >= {tolerance} similar to the torch reference")
+    return all_passed
+
+# Measures sentences per second for increasing worker counts, one thread per worker
+def check_scaling(backend, max_workers, sample_size, batch_size=32):
+    texts = load_sample_texts(sample_size)
+    worker_counts = []
+    workers = 1
+    while workers < max_workers:
+        worker_counts.append(workers)
+        workers *= 2
+    worker_counts.append(max_workers)
+
+    print(f"Encoding {len(texts)} sentences with the {backend} backend, 1 thread per worker")
+    print('-' * 56)
+    print(f"{'Workers':>8} {'Sent/s':>12} {'Speedup':>10} {'Efficiency':>12}")
+    single_rate = None
+    for workers in worker_counts:
+        with EncodingPool(backend, workers, 1) as pool:
+            # Warm-up so model loading in the workers is not counted
+            pool.encode(texts[:workers * 8], batch_size=batch_size, chunk_size=8)
+            embeddings, rate = measure_throughput(pool, texts, batch_size)
+        single_rate = single_rate or rate
+        print(f"{workers:>8} {rate:>12.1f} {rate / single_rate:>9.2f}x {rate / single_rate / workers:>11.0%}")
+    print('-' * 56)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check CPU inference backends against the stock torch model for accuracy and speed.")
+    parser.add_argument('--backend', choices=BACKENDS, action='append', help="backend to check (repeatable, default: all)")
+    parser.add_argument('--threads', type=int, default=None, help="intra-op threads per backend (default: library default)")
+    parser.add_argument('--sample-size', type=int, default=512, help="number of sentences to encode (default: 512)")
+    parser.add_argument('--tolerance', type=float, default=0.99, help="minimum cosine similarity to the reference (default: 0.99)")
+    parser.add_argument('--scaling', type=int, metavar='MAX_WORKERS', default=None, help="instead of the backend check, measure multi-process speedup from 1 up to MAX_WORKERS workers")
+    parser.add_argument('--batching', action='store_true', help="instead of the backend check, compare length-bucketed batching with fixed batches of 32")
+    parser.add_argument('--token-budget', type=int, default=TOKEN_BUDGET, help=f"padded tokens per bucketed batch (default: {TOKEN_BUDGET})")
+    parser.add_argument('--memory-limit', type=int, default=MEMORY_LIMIT_MB, help=f"estimated activation memory per bucketed batch in MB (default: {MEMORY_LIMIT_MB})")
+    args = parser.parse_args()
+    if args.batching:
+        check_batching((args.backend or ['torch'])[0], args.threads, args.sample_size, args.token_budget, args.memory_limit)
+        sys.exit(0)
+    if args.scaling:
+        check_scaling((args.backend or ['torch'])[0], args.scaling, args.sample_size)
+        sys.exit(0)
+    passed = check_backends(args.backend or BACKENDS, args.threads, args.sample_size, args.tolerance)
+    sys.exit(0 if passed else 1)
@@ -0,0 +1,164 @@
+import os
+import re
+import json
+import shutil
+import hashlib
+import pickle
+from datetime import datetime
+import numpy as np
+
+# File names used inside a note store directory, either the 'pickle' folder (single deck, older layout)
+# or one of the per-deck shards in 'pickle/decks'
+PICKLE_NAME = 'note_card_embeddings.pkl'
+NOTES_NAME = 'note_card_notes.pkl'
+FLOAT_NAME = 'note_card_embeddings_f32.npy'
+QUANTIZED_NAME = 'note_card_embeddings_int8.npz'
+PROJECTION_NAME = 'note_pca_projection.npy'
+
+# The catalog of embedded decks lives in the 'pickle' folder, each deck's shard in 'pickle/decks/<deck>'
+CATALOG_NAME = 'catalog.json'
+DECKS_DIR = 'decks'
+
+# Loads the note IDs, texts and embeddings of the older single-deck pickle
+def load_note_pickle(store_dir):
+    with open(os.path.join(store_dir, PICKLE_NAME), 'rb') as f:
+        note_card_ids, note_card_texts, note_card_embeddings = pickle.load(f)
+    return note_card_ids, note_card_texts, note_card_embeddings
+
+# Scales every row to unit length so that dot products are cosine similarities
+def normalize_rows(embeddings):
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return embeddings / norms
+
+# Symmetric int8 quantization with one scale per embedding dimension
+def quantize_embeddings(embeddings):
+    scales = np.abs(embeddings).max(axis=0) / 127
+    scales[scales == 0] = 1
+    codes = np.clip(np.rint(embeddings / scales), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+# Writes the notes and their unit-length float32 embeddings, plus the int8 codes when asked for. Embeddings that
+# were reduced with a projection are saved with it, and a projection left from an earlier build is removed.
+# Reduced rows are projections of unit-length rows and are kept as they are, so their dot products with a
+# projected query approximate the full cosine similarities and compare with the scores of full-size decks.
+def save_note_store(store_dir, note_card_ids, note_card_texts, embeddings, quantize=False, projection=None):
+    os.makedirs(store_dir, exist_ok=True)
+    normalized = normalize_rows(embeddings) if projection is None else np.asarray(embeddings, dtype=np.float32)
+    with open(os.path.join(store_dir, NOTES_NAME), 'wb') as f:
+        pickle.dump((note_card_ids, note_card_texts), f)
+    np.save(os.path.join(store_dir, FLOAT_NAME), normalized)
+    projection_path = os.path.join(store_dir, PROJECTION_NAME)
+    if projection is not None:
+        np.save(projection_path, projection)
+    elif os.path.exists(projection_path):
+        os.remove(projection_path)
+    if quantize:
+        save_quantized_codes(store_dir, normalized)
+    return normalized
+
+# Principal directions of unit-length embeddings as a (dimensions x original dimensions) matrix, with the share
+# of the embeddings' energy they keep. The embeddings are not centered, so dot products of projected vectors
+# approximate the original cosine similarities.
+def fit_projection(normalized, dimensions):
+    second_moment = np.zeros((normalized.shape[1], normalized.shape[1]), dtype=np.float64)
+    for start in range(0, normalized.shape[0], 8192):
+        block = np.asarray(normalized[start:start + 8192], dtype=np.float64)
+        second_moment += block.T @ block
+    eigenvalues, eigenvectors = np.linalg.eigh(second_moment)
+    order = np.argsort(eigenvalues)[::-1][:dimensions]
+    return eigenvectors[:, order].T.astype(np.float32), float(eigenvalues[order].sum() / eigenvalues.sum())
+
+# Reduces embeddings (or a query vector) with a projection
+def project_rows(embeddings, projection):
+    return np.asarray(embeddings, dtype=np.float32) @ projection.T
+
+# The projection a store's embeddings were reduced with, None for full-dimension stores
+def load_projection(store_dir):
+    projection_path = os.path.join(store_dir, PROJECTION_NAME)
+    if not os.path.exists(projection_path):
+        return None
+    return np.load(projection_path)
+
+# Writes the int8 codes of unit-length embeddings, returns their size and the size of the float32 rows
+def save_quantized_codes(store_dir, normalized):
+    codes, scales = quantize_embeddings(normalized)
+    np.savez(os.path.join(store_dir, QUANTIZED_NAME), codes=codes, scales=scales)
+    return codes.nbytes + scales.nbytes, normalized.nbytes
+
+# True when a file exists and is at least as new as the file it was derived from
+def is_current(store_dir, name, source_name):
+    path = os.path.join(store_dir, name)
+    source_path = os.path.join(store_dir, source_name)
+    if not os.path.exists(path):
+        return False
+    return not (os.path.exists(source_path) and os.path.getmtime(source_path) > os.path.getmtime(path))
+
+# Loads a store's notes and memory-maps its float32 embeddings, so rows are only read from disk when scored.
+# A store that only has the older pickle is converted on first use.
+def load_note_store(store_dir):
+    if not (is_current(store_dir, FLOAT_NAME, PICKLE_NAME) and os.path.exists(os.path.join(store_dir, NOTES_NAME))):
+        print(f"Converting {os.path.join(store_dir, PICKLE_NAME)} to the memory-mapped note store...")
+        note_card_ids, note_card_texts, embeddings = load_note_pickle(store_dir)
+        save_note_store(store_dir, note_card_ids, note_card_texts, embeddings)
+        del embeddings
+    with open(os.path.join(store_dir, NOTES_NAME), 'rb') as f:
+        note_card_ids, note_card_texts = pickle.load(f)
+    note_matrix = np.load(os.path.join(store_dir, FLOAT_NAME), mmap_mode='r')
+    return note_card_ids, note_card_texts, note_matrix
+
+# Loads the int8 codes into memory alongside the memory-mapped float32 rows used for re-ranking
+def load_quantized_store(store_dir):
+    note_card_ids, note_card_texts, note_matrix = load_note_store(store_dir)
+    if not is_current(store_dir, QUANTIZED_NAME, FLOAT_NAME):
+        print("Building the int8 note store from the float32 embeddings...")
+        save_quantized_codes(store_dir, np.asarray(note_matrix))
+    with np.load(os.path.join(store_dir, QUANTIZED_NAME)) as quantized:
+        codes = quantized['codes']
+        scales = quantized['scales']
+    return note_card_ids, note_card_texts, codes, scales, note_matrix
+
+# File-system safe version of a deck name, used for its shard and checkpoint folders. Names that only differ in
+# characters replaced here (such as 'Step 1' and 'Step::1', or two non-Latin names) get different folders from
+# a short hash of the exact name.
+def deck_slug(deck_name):
+    readable = re.sub(r'[^A-Za-z0-9_-]+', '_', deck_name).strip('_') or 'deck'
+    return f"{readable}_{hashlib.sha1(deck_name.encode('utf-8')).hexdigest()[:8]}"
+
+# Folder holding the shard of one deck
+def deck_store_dir(pickle_dir, deck_name):
+    return os.path.join(pickle_dir, DECKS_DIR, deck_slug(deck_name))
+
+# Reads the list of embedded decks, empty when nothing was embedded with the per-deck layout yet
+def load_catalog(pickle_dir):
+    catalog_path = os.path.join(pickle_dir, CATALOG_NAME)
+    if not os.path.exists(catalog_path):
+        return []
+    with open(catalog_path) as f:
+        return json.load(f)['decks']
+
+# Adds or replaces a deck's entry in the catalog. A shard the deck had under an older folder name is removed,
+# unless another deck's entry still points at it.
+def update_catalog(pickle_dir, deck_name, note_count, model_name, dimension, **extra):
+    catalog = load_catalog(pickle_dir)
+    entries = [entry for entry in catalog if entry['deck'] != deck_name]
+    previous_dirs = {entry['directory'] for entry in catalog if entry['deck'] == deck_name}
+    entry = {
+        'deck': deck_name,
+        'directory': os.path.join(DECKS_DIR, deck_slug(deck_name)),
+        'note_count': note_count,
+        'model': model_name,
+        'dimension': dimension,
+        'built': datetime.now().isoformat(timespec='seconds'),
+    }
+    entry.update(extra)
+    entries.append(entry)
+    entries.sort(key=lambda e: e['deck'])
+    catalog_path = os.path.join(pickle_dir, CATALOG_NAME)
+    with open(catalog_path + '.tmp', 'w') as f:
+        json.dump({'decks': entries}, f, indent=2)
+    os.replace(catalog_path + '.tmp', catalog_path)
+    for directory in previous_dirs - {e['directory'] for e in entries}:
+        shutil.rmtree(os.path.join(pickle_dir, directory), ignore_errors=True)
+    return entry
@@ -0,0 +1,206 @@
+import os
+import sys
+import json
+import time
+import atexit
+import functools
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:
+    # resource is unavailable on Windows, RSS peaks are then not reported
+    resource = None
+
+# Profiling is opt-in, nothing is recorded until enable_profiling() is called
+_enabled = False
+_script_name = None
+_output_dir = None
+_start_time = None
+_stages = {}
+_requests = {}
+_local = threading.local()
+_lock = threading.Lock()
+
+# Stages nest per thread, so pipeline threads each keep their own stack of running stages
+def _stage_stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+# Returns the peak resident set size of the process in MB (macOS reports bytes, Linux reports KB)
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+# Turns on stage timing, AnkiConnect request counting and memory tracking for this process
+def enable_profiling(script_name, output_dir):
+    global _enabled, _script_name, _output_dir, _start_time
+    if _enabled:
+        return
+    _enabled = True
+    _script_name = script_name
+    _output_dir = output_dir
+    _start_time = time.perf_counter()
+    tracemalloc.start()
+    atexit.register(write_profile)
+
+def is_enabled():
+    return _enabled
+
+# Times a block of code and records its wall time and memory peaks under the given stage name. tracemalloc
+# keeps one peak for the whole process, so only stages of the main thread reset and read it; stages run from
+# worker threads (the pipeline's fetch and clean stages) are time-only, and a main-thread stage's peak covers
+# every thread's allocations while it ran.
+@contextmanager
+def stage(name):
+    if not _enabled:
+        yield
+        return
+    if threading.current_thread() is not threading.main_thread():
+        with _timed_stage(name):
+            yield
+        return
+
+    # Each running stage tracks its own Python allocation peak; tracemalloc only keeps one global
+    # peak, so the parent's peak so far is saved before the child resets it
+    stack = _stage_stack()
+    if stack:
+        stack[-1][1] = max(stack[-1][1], tracemalloc.get_traced_memory()[1])
+    tracemalloc.reset_peak()
+    stack.append([name, 0])
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_peak = max(stack.pop()[1], tracemalloc.get_traced_memory()[1])
+        if stack:
+            stack[-1][1] = max(stack[-1][1], stage_peak)
+        _record_stage(name, elapsed, stage_peak / (1024 * 1024))
+
+# Worker-thread stage: its wall time is recorded and it is pushed on the thread's own stack so AnkiConnect
+# requests are attributed to it, but tracemalloc is left alone
+@contextmanager
+def _timed_stage(name):
+    stack = _stage_stack()
+    stack.append([name, 0])
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stack.pop()
+        _record_stage(name, time.perf_counter() - start, None)
+
+# Adds one run of a stage to its record; py_peak_mb stays None for time-only stages
+def _record_stage(name, elapsed, py_peak_mb):
+    with _lock:
+        record = _stages.setdefault(name, {'calls': 0, 'total_s': 0.0, 'max_s': 0.0, 'py_peak_mb': None, 'rss_peak_mb': None})
+        record['calls'] += 1
+        record['total_s'] += elapsed
+        record['max_s'] = max(record['max_s'], elapsed)
+        if py_peak_mb is not None:
+            record['py_peak_mb'] = max(record['py_peak_mb'] or 0.0, py_peak_mb)
+        record['rss_peak_mb'] = _peak_rss_mb()
+
+# Decorator form of stage() for wrapping a whole function
+def timed(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# Records the latency of a single AnkiConnect call, attributed to the innermost running stage
+def record_request(action, elapsed, failed=False):
+    if not _enabled:
+        return
+    stack = _stage_stack()
+    current_stage = stack[-1][0] if stack else '(no stage)'
+    with _lock:
+        record = _requests.setdefault(action, {'calls': 0, 'failures': 0, 'total_s': 0.0, 'max_s': 0.0, 'latencies_s': [], 'stages': {}})
+        record['calls'] += 1
+        record['total_s'] += elapsed
+        record['max_s'] = max(record['max_s'], elapsed)
+        record['latencies_s'].append(elapsed)
+        if failed:
+            record['failures'] += 1
+        record['stages'][current_stage] = record['stages'].get(current_stage, 0) + 1
+
+# Nearest-rank percentile of a list of latencies
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+# Builds the JSON-serializable profile of everything recorded so far
+def build_profile():
+    requests_summary = {}
+    for action, record in _requests.items():
+        latencies = record['latencies_s']
+        requests_summary[action] = {
+            'calls': record['calls'],
+            'failures': record['failures'],
+            'total_s': record['total_s'],
+            'mean_ms': 1000 * record['total_s'] / record['calls'],
+            'p50_ms': 1000 * _percentile(latencies, 0.50),
+            'p95_ms': 1000 * _percentile(latencies, 0.95),
+            'max_ms': 1000 * record['max_s'],
+            'stages': record['stages'],
+        }
+    return {
+        'script': _script_name,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'total_wall_s': time.perf_counter() - _start_time,
+        'py_peak_mb': tracemalloc.get_traced_memory()[1] / (1024 * 1024) if tracemalloc.is_tracing() else None,
+        'rss_peak_mb': _peak_rss_mb(),
+        'stages': _stages,
+        'requests': requests_summary,
+    }
+
+# Prints a short table of stage timings and AnkiConnect round trips
+def print_summary(profile):
+    print('=' * 72)
+    print(f"Profile for {profile['script']}: {profile['total_wall_s']:.2f} s total", end='')
+    if profile['rss_peak_mb'] is not None:
+        print(f", peak RSS {profile['rss_peak_mb']:.1f} MB")
+    else:
+        print()
+    print('-' * 72)
+    print(f"{'Stage':<32} {'Calls':>6} {'Total s':>10} {'Max s':>10} {'Py peak MB':>11}")
+    for name, record in profile['stages'].items():
+        py_peak = f"{record['py_peak_mb']:.1f}" if record['py_peak_mb'] is not None else 'time only'
+        print(f"{name:<32} {record['calls']:>6} {record['total_s']:>10.3f} {record['max_s']:>10.3f} {py_peak:>11}")
+    if profile['requests']:
+        print('-' * 72)
+        print(f"{'AnkiConnect action':<32} {'Calls':>6} {'Total s':>10} {'Mean ms':>10} {'p95 ms':>11}")
+        for action, record in profile['requests'].items():
+            print(f"{action:<32} {record['calls']:>6} {record['total_s']:>10.3f} {record['mean_ms']:>10.1f} {record['p95_ms']:>11.1f}")
+    print('=' * 72)
+
+# Writes the JSON profile and prints the summary, registered to run at exit
+def write_profile():
+    global _enabled
+    if not _enabled:
+        return
+    profile = build_profile()
+    _enabled = False
+    tracemalloc.stop()
+    os.makedirs(_output_dir, exist_ok=True)
+    timestamp = datetime.now().strftime('%Y_%b_%d_%H_%M_%S')
+    profile_path = os.path.join(_output_dir, f'profile_{_script_name}_{timestamp}.json')
+    with open(profile_path, 'w') as f:
+        json.dump(profile, f, indent=2)
+    print_summary(profile)
+    print(f"Profile saved to {profile_path}")
@@ -0,0 +1,210 @@
+import numpy as np
+from note_store import normalize_rows
+
+# Number of int8 rows upcast to float32 at a time during the scan
+SCAN_BLOCK_ROWS = 8192
+
+# Frames scored at a time by the blockwise engine, a tile is at most TILE_FRAMES x SCAN_BLOCK_ROWS scores
+TILE_FRAMES = 256
+
+# Ways of combining a note's similarities to all frames into its score
+AGGREGATES = ['mean', 'max', 'topk', 'percentile']
+
+# The percentile aggregate counts each note's similarities in a histogram of fixed bins; similarities below the
+# range fall into the first bin, which only affects percentiles far below anything that ranks a note highly
+PERCENTILE_RANGE = (-0.25, 1.0)
+PERCENTILE_BINS = 125
+
+# The mean cosine similarity of a note over all frames equals the note's cosine with the mean unit frame vector.
+# Frames that were deduplicated before encoding count as often as they occurred.
+def mean_frame_vector(frame_embeddings, weights=None):
+    if weights is None:
+        return normalize_rows(frame_embeddings).mean(axis=0)
+    return (weights @ normalize_rows(frame_embeddings) / weights.sum()).astype(np.float32)
+
+# Running sum of unit frame vectors, so the mean frame vector of a document can be built chunk by chunk
+# without keeping every frame embedding
+class FrameAccumulator:
+    def __init__(self):
+        self.total = None
+        self.count = 0
+
+    # Folds a chunk of frame embeddings, each counted as often as its weight says, into the running sum
+    def add(self, frame_embeddings, weights=None):
+        if weights is None:
+            weights = np.ones(len(frame_embeddings), dtype=np.int64)
+        chunk_total = weights.astype(np.float64) @ normalize_rows(frame_embeddings)
+        self.total = chunk_total if self.total is None else self.total + chunk_total
+        self.count += int(weights.sum())
+
+    # The same vector mean_frame_vector returns for all the frames added so far
+    def mean_vector(self):
+        return (self.total / self.count).astype(np.float32)
+
+# Scores every note against the query from unit-length rows, in blocks so a memory-mapped matrix is never copied whole
+def scan_scores(query, note_matrix):
+    scores = np.empty(note_matrix.shape[0], dtype=np.float32)
+    for start in range(0, note_matrix.shape[0], SCAN_BLOCK_ROWS):
+        scores[start:start + SCAN_BLOCK_ROWS] = np.asarray(note_matrix[start:start + SCAN_BLOCK_ROWS], dtype=np.float32) @ query
+    return scores
+
+# Approximate scores of every note from the int8 codes, scanned in blocks so the full matrix is never upcast
+def quantized_scan(query, codes, scales):
+    weighted_query = (query * scales).astype(np.float32)
+    scores = np.empty(codes.shape[0], dtype=np.float32)
+    for start in range(0, codes.shape[0], SCAN_BLOCK_ROWS):
+        block = codes[start:start + SCAN_BLOCK_ROWS].astype(np.float32)
+        scores[start:start + SCAN_BLOCK_ROWS] = block @ weighted_query
+    return scores
+
+# Exact scores of selected notes from the unit-length float32 rows
+def exact_scores(query, note_matrix, indices):
+    indices = np.sort(indices)
+    rows = np.asarray(note_matrix[indices], dtype=np.float32)
+    return indices, rows @ query
+
+# Top-k notes by mean frame similarity (query is the mean frame vector) using the int8 scan and an exact
+# float32 re-rank of the shortlist
+def quantized_top_k(query, codes, scales, note_matrix, k=250, rerank=300):
+    k = min(k, codes.shape[0])
+    if k == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    approximate = quantized_scan(query, codes, scales)
+    shortlist_size = min(max(rerank, k), codes.shape[0])
+    shortlist = np.argpartition(-approximate, shortlist_size - 1)[:shortlist_size]
+    indices, scores = exact_scores(query, note_matrix, shortlist)
+
+    # Rounding to the nearest code moves each dimension by at most half a scale step, which bounds the
+    # scan error; any note whose approximate score is within that bound of the k-th exact score could
+    # still belong in the top k, so it is re-scored as well and the result matches the float32 ranking
+    error_bound = float(np.sum(np.abs(query) * scales) / 2) + 1e-6
+    kth_score = np.partition(scores, len(scores) - k)[len(scores) - k]
+    borderline = np.flatnonzero(approximate >= kth_score - error_bound)
+    borderline = np.setdiff1d(borderline, indices)
+    if borderline.size:
+        extra_indices, extra_scores = exact_scores(query, note_matrix, borderline)
+        indices = np.concatenate([indices, extra_indices])
+        scores = np.concatenate([scores, extra_scores])
+
+    order = np.argsort(-scores, kind='stable')[:k]
+    return indices[order], scores[order]
+
+# Blockwise engine: frames are scored against the notes in tiles of bounded size and every tile is folded into
+# running per-note aggregates, so the frames x notes matrix is never held and memory does not grow with the
+# document. Subclasses keep the aggregate; frames can be added in as many chunks as needed, and deduplicated
+# frames carry the number of times they occurred as their weight.
+class TileAggregator:
+    def __init__(self, note_matrix, projection=None):
+        self.note_matrix = note_matrix
+        self.projection = projection
+        self.note_count = note_matrix.shape[0]
+        self.frame_count = 0
+
+    def add(self, frame_embeddings, weights=None):
+        frames = normalize_rows(frame_embeddings)
+        # Notes reduced with a projection are compared with frames reduced the same way
+        if self.projection is not None:
+            frames = frames @ self.projection.T
+        if not len(frames):
+            return
+        if weights is None:
+            weights = np.ones(len(frames), dtype=np.int64)
+        for start in range(0, self.note_count, SCAN_BLOCK_ROWS):
+            block = np.asarray(self.note_matrix[start:start + SCAN_BLOCK_ROWS], dtype=np.float32)
+            for frame_start in range(0, len(frames), TILE_FRAMES):
+                tile_weights = weights[frame_start:frame_start + TILE_FRAMES]
+                self.fold(start, block @ frames[frame_start:frame_start + TILE_FRAMES].T, tile_weights)
+        self.frame_count += int(weights.sum())
+
+# Mean similarity over all frames, the same scores as scanning the notes with mean_frame_vector
+class MeanAggregator(TileAggregator):
+    def __init__(self, note_matrix, projection=None):
+        super().__init__(note_matrix, projection)
+        self.totals = np.zeros(self.note_count, dtype=np.float64)
+
+    def fold(self, start, tile, weights):
+        self.totals[start:start + len(tile)] += tile @ weights.astype(np.float32)
+
+    def scores(self):
+        return (self.totals / max(self.frame_count, 1)).astype(np.float32)
+
+# Best similarity to any single frame
+class MaxAggregator(TileAggregator):
+    def __init__(self, note_matrix, projection=None):
+        super().__init__(note_matrix, projection)
+        self.best = np.full(self.note_count, -np.inf, dtype=np.float32)
+
+    def fold(self, start, tile, weights):
+        np.maximum(self.best[start:start + len(tile)], tile.max(axis=1), out=self.best[start:start + len(tile)])
+
+    def scores(self):
+        return self.best.copy()
+
+# Mean of the k best frame similarities, a note matching one section strongly is not diluted by the rest
+class TopKMeanAggregator(TileAggregator):
+    def __init__(self, note_matrix, k=5, projection=None):
+        super().__init__(note_matrix, projection)
+        self.k = k
+        self.best = np.full((self.note_count, k), -np.inf, dtype=np.float32)
+
+    def fold(self, start, tile, weights):
+        # A repeated frame can fill several of the k places
+        tile = np.repeat(tile, np.minimum(weights, self.k), axis=1)
+        combined = np.concatenate([self.best[start:start + len(tile)], tile], axis=1)
+        self.best[start:start + len(tile)] = np.partition(combined, combined.shape[1] - self.k, axis=1)[:, -self.k:]
+
+    def scores(self):
+        kept = min(self.k, self.frame_count)
+        if not kept:
+            return np.zeros(self.note_count, dtype=np.float32)
+        return (np.where(np.isfinite(self.best), self.best, 0).sum(axis=1) / kept).astype(np.float32)
+
+# Approximate percentile of the frame similarities from a fixed-size histogram per note
+class PercentileAggregator(TileAggregator):
+    def __init__(self, note_matrix, percentile=90, projection=None):
+        super().__init__(note_matrix, projection)
+        self.percentile = percentile
+        self.counts = np.zeros((self.note_count, PERCENTILE_BINS), dtype=np.uint32)
+
+    def fold(self, start, tile, weights):
+        low, high = PERCENTILE_RANGE
+        bins = np.clip(((tile - low) * (PERCENTILE_BINS / (high - low))).astype(np.int64), 0, PERCENTILE_BINS - 1)
+        bins += (np.arange(len(tile)) * PERCENTILE_BINS)[:, None]
+        counts = np.bincount(bins.ravel(), weights=np.broadcast_to(weights, tile.shape).ravel(), minlength=len(tile) * PERCENTILE_BINS)
+        self.counts[start:start + len(tile)] += counts.reshape(len(tile), PERCENTILE_BINS).astype(np.uint32)
+
+    # Interpolates linearly inside the bin where the cumulative count reaches the percentile
+    def scores(self):
+        low, high = PERCENTILE_RANGE
+        width = (high - low) / PERCENTILE_BINS
+        target = self.percentile / 100 * self.frame_count
+        scores = np.empty(self.note_count, dtype=np.float32)
+        for start in range(0, self.note_count, SCAN_BLOCK_ROWS):
+            counts = self.counts[start:start + SCAN_BLOCK_ROWS].astype(np.int64)
+            cumulative = np.cumsum(counts, axis=1)
+            bins = np.argmax(cumulative >= target, axis=1)
+            rows = np.arange(len(counts))
+            in_bin = np.maximum(counts[rows, bins], 1)
+            fraction = np.clip((target - (cumulative[rows, bins] - counts[rows, bins])) / in_bin, 0, 1)
+            scores[start:start + len(counts)] = low + (bins + fraction) * width
+        return scores
+
+# Creates the aggregator for one of AGGREGATES
+def make_aggregator(aggregate, note_matrix, top_k=5, percentile=90, projection=None):
+    if aggregate == 'mean':
+        return MeanAggregator(note_matrix, projection)
+    if aggregate == 'max':
+        return MaxAggregator(note_matrix, projection)
+    if aggregate == 'topk':
+        return TopKMeanAggregator(note_matrix, top_k, projection)
+    if aggregate == 'percentile':
+        return PercentileAggregator(note_matrix, percentile, projection)
+    raise ValueError(f"Unknown aggregate '{aggregate}', choose one of {', '.join(AGGREGATES)}")
+
+# Reciprocal rank fusion: each ranking adds 1 / (offset + rank) for the notes it contains, best fused first
+def reciprocal_rank_fusion(rankings, offset=60):
+    fused = {}
+    for ranking in rankings:
+        for rank, index in enumerate(ranking):
+            fused[index] = fused.get(index, 0.0) + 1 / (offset + rank + 1)
+    return sorted(fused, key=lambda index: fused[index], reverse=True)
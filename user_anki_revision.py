@@ -1,59 +1,46 @@
 import os
-import json
-import requests
 import csv
 import ast
+import argparse
+import profiling
+import anki_connect
+import anki_mirror
 from datetime import datetime
 
-# AnkiConnect URL
-ANKI_CONNECT_URL = 'http://localhost:8765'
-
-# Function to call AnkiConnect
-def invoke(action, params={}):
-    request_payload = json.dumps({
-        'action': action,
-        'version': 6,
-        'params': params
-    })
-    response = requests.post(ANKI_CONNECT_URL, data=request_payload)
-    if response.status_code != 200:
-        raise Exception(f"AnkiConnect API request failed with status code {response.status_code}")
-    response_json = response.json()
-    if response_json.get('error'):
-        raise Exception(response_json['error'])
-    return response_json['result']
-
-# Function to get tags of a note
-def get_note_tags(note_id):
-    note_info = invoke('notesInfo', {'notes': [int(note_id)]})
-    return note_info[0]['tags']
-
-# Function to update tags of a note
-def update_note_tags(note_id, new_tags):
-    current_tags = get_note_tags(note_id)
-    for tag in new_tags:
-        if tag not in current_tags:
-            current_tags.append(tag)
-    invoke('updateNoteTags', {'note': int(note_id), 'tags': current_tags})
-
-# Function to remove tags from a note
-def remove_note_tags(note_id, tags_to_remove):
-    current_tags = get_note_tags(note_id)
-    updated_tags = [tag for tag in current_tags if tag not in tags_to_remove]
-    invoke('updateNoteTags', {'note': int(note_id), 'tags': updated_tags})
-
-# Function to suspend or unsuspend cards
+# Function to get the tags of notes, by note ID, read from the local mirror of Anki
+def get_note_tags(note_ids):
+    note_tags = anki_mirror.open_mirror().note_tags(note_ids)
+    return {note_id: note_tags[int(note_id)] for note_id in note_ids if int(note_id) in note_tags}
+
+# Function to add tags to notes, the mirror is updated along with Anki
+def update_note_tags(note_ids, new_tags):
+    anki_connect.add_tags(note_ids, new_tags)
+    anki_mirror.open_mirror().record_tags_added(note_ids, new_tags)
+
+# Function to remove tags from notes
+def remove_note_tags(note_ids, tags_to_remove):
+    anki_connect.remove_tags(note_ids, tags_to_remove)
+    anki_mirror.open_mirror().record_tags_removed(note_ids, tags_to_remove)
+
+# Function to add a tag to the notes that do not have it yet, returns those notes
+def add_missing_tag(note_ids, tag):
+    note_tags = get_note_tags(note_ids)
+    missing = [note_id for note_id in note_ids if note_id in note_tags and tag not in note_tags[note_id]]
+    update_note_tags(missing, [tag])
+    return missing
+
+# Function to suspend or unsuspend cards, only the cards whose state changes are sent to Anki
 def set_card_suspend(note_ids, suspend):
-    for note_id in note_ids:
-        card_ids = invoke('findCards', {'query': f'nid:{int(note_id)}'})
-        if card_ids:
-            card_info = invoke('cardsInfo', {'cards': card_ids})
-            for card in card_info:
-                if (suspend and not card['queue'] == -1) or (not suspend and card['queue'] == -1):
-                    if suspend:
-                        invoke('suspend', {'cards': [card['cardId']]})
-                    else:
-                        invoke('unsuspend', {'cards': [card['cardId']]})
+    mirror = anki_mirror.open_mirror()
+    card_ids = [card_id for card_ids in mirror.note_cards(note_ids).values() for card_id in card_ids]
+    card_queues = mirror.card_queues(card_ids)
+    if suspend:
+        changed_cards = [card_id for card_id in card_ids if card_queues.get(card_id) != anki_mirror.SUSPENDED_QUEUE]
+        anki_connect.suspend(changed_cards)
+    else:
+        changed_cards = [card_id for card_id in card_ids if card_queues.get(card_id) == anki_mirror.SUSPENDED_QUEUE]
+        anki_connect.unsuspend(changed_cards)
+    mirror.record_suspended(changed_cards, suspend)
 
 # Function to load modification files
 def load_modification_files(output_dir):
@@ -173,6 +160,9 @@ def main():
     modifications = parse_modification_file(selected_filepath)
     header = list(modifications[0].keys()) if modifications else []
 
+    # Only the notes and cards changed in Anki since the last run are fetched, every read after this is local
+    anki_mirror.open_mirror().sync_notes(set(mod['Note ID'] for mod in modifications))
+
     # Gets the users desired modification
     print("")
     print("What would you like to do with the referenced notes and cards?")
@@ -292,11 +282,9 @@ def main():
                         continue
                 confirm = input(f"\nDo you want to change the tag '{old_tag}' to '{tag_to_add}' on all selected notes? (y/n): ").strip().lower()
                 if confirm == 'y':
-                    for note_id in selected_note_ids:
-                        remove_note_tags(note_id, [old_tag])
-                        full_tags = get_note_tags(note_id)
-                        if tag_to_add not in full_tags:
-                            update_note_tags(note_id, [tag_to_add])
+                    with profiling.stage('action_change_tag'):
+                        remove_note_tags(selected_note_ids, [old_tag])
+                        for note_id in add_missing_tag(selected_note_ids, tag_to_add):
                             for mod in modifications:
                                 if mod['Note ID'] == note_id:
                                     mod['Added Tags'] = [tag_to_add]
@@ -322,11 +310,9 @@ def main():
                 tag_to_add = input("\nEnter the new tag: ").strip()
                 confirm = input(f"\nDo you want to change the tag '{old_tag}' to '{tag_to_add}' on all selected notes? (y/n): ").strip().lower()
                 if confirm == 'y':
-                    for note_id in selected_note_ids:
-                        remove_note_tags(note_id, [old_tag])
-                        full_tags = get_note_tags(note_id)
-                        if tag_to_add not in full_tags:
-                            update_note_tags(note_id, [tag_to_add])
+                    with profiling.stage('action_change_tag'):
+                        remove_note_tags(selected_note_ids, [old_tag])
+                        for note_id in add_missing_tag(selected_note_ids, tag_to_add):
                             for mod in modifications:
                                 if mod['Note ID'] == note_id:
                                     mod['Added Tags'] = [tag_to_add]
@@ -355,11 +341,12 @@ def main():
             tag_to_remove = next(iter(all_tags))
             confirm = input(f"\nDo you want to remove the tag '{tag_to_remove}' from all selected notes? (y/n): ").strip().lower()
             if confirm == 'y':
-                for note_id in selected_note_ids:
-                    remove_note_tags(note_id, [tag_to_remove])
-                    for mod in modifications:
-                        if mod['Note ID'] == note_id:
-                            mod['Added Tags'] = []
+                with profiling.stage('action_remove_tag'):
+                    remove_note_tags(selected_note_ids, [tag_to_remove])
+                    for note_id in selected_note_ids:
+                        for mod in modifications:
+                            if mod['Note ID'] == note_id:
+                                mod['Added Tags'] = []
             else:
                 print("Exiting...")
 
@@ -381,13 +368,14 @@ def main():
                 tag_to_remove = all_tags[selected_tag_idx]
                 confirm = input(f"\nDo you want to remove the tag '{tag_to_remove}' from all selected notes? (y/n): ").strip().lower()
                 if confirm == 'y':
-                    for note_id in selected_note_ids:
-                        remove_note_tags(note_id, [tag_to_remove])
-                        for mod in modifications:
-                            if mod['Note ID'] == note_id:
-                                current_tags = mod['Added Tags']
-                                current_tags.remove(tag_to_remove)
-                                mod['Added Tags'] = current_tags
+                    with profiling.stage('action_remove_tag'):
+                        remove_note_tags(selected_note_ids, [tag_to_remove])
+                        for note_id in selected_note_ids:
+                            for mod in modifications:
+                                if mod['Note ID'] == note_id:
+                                    current_tags = mod['Added Tags']
+                                    current_tags.remove(tag_to_remove)
+                                    mod['Added Tags'] = current_tags
                     break
                 else:
                     continue
@@ -403,10 +391,8 @@ def main():
                     continue
             confirm = input(f"\nDo you want to add the tag '{tag_to_add}' to all selected notes? (y/n): ").strip().lower()
             if confirm == 'y':
-                for note_id in selected_note_ids:
-                    current_tags = get_note_tags(note_id)
-                    if tag_to_add not in current_tags:
-                        update_note_tags(note_id, [tag_to_add])
+                with profiling.stage('action_add_tag'):
+                    for note_id in add_missing_tag(selected_note_ids, tag_to_add):
                         for mod in modifications:
                             if mod['Note ID'] == note_id:
                                 mod['Added Tags'].append(tag_to_add)
@@ -418,7 +404,8 @@ def main():
     elif action == 4:
         confirm = input("\nDo you want to suspend all selected notes? (y/n): ").strip().lower()
         if confirm == 'y':
-            set_card_suspend(selected_note_ids, True)
+            with profiling.stage('action_suspend'):
+                set_card_suspend(selected_note_ids, True)
             for note_id in selected_note_ids:
                 for mod in modifications:
                     if mod['Note ID'] == note_id:
@@ -431,7 +418,8 @@ def main():
     elif action == 5:
         confirm = input("\nDo you want to unsuspend all selected notes? (y/n): ").strip().lower()
         if confirm == 'y':
-            set_card_suspend(selected_note_ids, False)
+            with profiling.stage('action_unsuspend'):
+                set_card_suspend(selected_note_ids, False)
             for note_id in selected_note_ids:
                 for mod in modifications:
                     if mod['Note ID'] == note_id:
@@ -443,4 +431,9 @@ def main():
         generate_output_file(modifications, header)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Revise the tags or suspension state of notes changed by doc_comparison.py.")
+    parser.add_argument('--profile', action='store_true', help="record per-stage timing, AnkiConnect round trips and peak memory, saved to 'debugging/'")
+    args = parser.parse_args()
+    if args.profile:
+        profiling.enable_profiling('user_anki_revision', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'debugging'))
     main()